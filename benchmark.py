@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# (c) 2011-2017 Simon Budig <simon@budig.de>
+#
+# timing harness for lamusica.py, run as ./benchmark.py
+
+import sys, os, struct, random, time, tempfile, subprocess
+import getopt, json, platform, contextlib
+
+import lamusica
+
+
+def synth_track (n_notes, seed=0, running_status=True, meta_every=200,
+                 pitches=(48, 96), channel=0):
+   # a dense melody track: noteon/noteoff pairs (in running status if
+   # wanted), sprinkled with controllers and every meta_every notes
+   # with meta text and sysex events.
+   rnd = random.Random (seed)
+   data = bytearray ()
+   data += bytes ((0x00, 0xc0 | channel, 0x00))
+   for i in range (n_notes):
+      note = rnd.randrange (*pitches)
+      data += lamusica.vlq (rnd.choice ((0, 60, 120, 240)))
+      data += bytes ((0x90 | channel, note, 100))
+      data += lamusica.vlq (rnd.choice ((60, 120)))
+      if running_status:
+         data += bytes ((note, 0))
+      else:
+         data += bytes ((0x80 | channel, note, 0))
+      if i % 50 == 0:
+         data += bytes ((0x00, 0xb0 | channel, 0x07, 0x64))
+      if meta_every and i % meta_every == 0:
+         data += b"\x00\xff\x01" + lamusica.vlq (5) + b"lamus"
+         data += b"\x00\xf0" + lamusica.vlq (4) + b"\x7e\x7f\x09\x01"
+   data += b"\x00\xff\x2f\x00"
+   return bytes (data)
+
+
+def synth_midi (tracks, timediv=480):
+   data = b"MThd" + struct.pack (">ihhh", 6, 1, len (tracks), timediv)
+   for t in tracks:
+      data += b"MTrk" + struct.pack (">i", len (t)) + t
+   return data
+
+
+def synth_tune (tracks=1, notes=1000, seed=0, running_status=True,
+                meta_every=200, pitches=(48, 96)):
+   # a deterministic multi track tune, notes are split over the tracks
+   return synth_midi ([synth_track (notes // tracks, seed + i, running_status,
+                                    meta_every, pitches, i % 16)
+                       for i in range (tracks)])
+
+
+def timeit (func, repeat=3):
+   best = None
+   for i in range (repeat):
+      t0 = time.perf_counter ()
+      func ()
+      dt = time.perf_counter () - t0
+      best = dt if best is None else min (best, dt)
+   return best
+
+
+def bench_parse ():
+   print ("MidiImporter.import_ticked_events")
+   print ("%10s %10s %10s %12s" % ("notes", "bytes", "seconds", "us/byte"))
+   for n_notes in (5000, 10000, 20000, 40000, 80000):
+      track = synth_track (n_notes)
+      def run ():
+         mi = lamusica.MidiImporter (lamusica.PianoRoll ([]))
+         mi.import_ticked_events (0, track)
+      dt = timeit (run)
+      print ("%10d %10d %10.4f %12.4f" % (n_notes, len (track), dt, dt * 1e6 / len (track)))
+
+
+class EventRecorder (lamusica.MidiImporter):
+   def __init__ (self):
+      lamusica.MidiImporter.__init__ (self, lamusica.PianoRoll ([]))
+      self.events = []
+
+
+   def import_event (self, ticks, track, eventdata):
+      self.events.append ((ticks, eventdata))
+      lamusica.MidiImporter.import_event (self, ticks, track, eventdata)
+
+
+def check_midi_roundtrip (filename):
+   # re-import the written file and re-encode every event, the result
+   # has to match the file byte by byte.
+   data = open (filename, "rb").read ()
+   mi = EventRecorder ()
+   mi.import_data (data)
+   track = bytearray ()
+   last = 0
+   for ticks, command in mi.events:
+      track += lamusica.vlq (ticks - last) + command
+      last = ticks
+   rebuilt = (data[:14] + b"MTrk" + struct.pack (">i", len (track)) + track)
+   if rebuilt != data:
+      raise Exception ("MIDI round trip mismatch for %s" % filename)
+   return mi
+
+
+def bench_midi_writer ():
+   model = lamusica.models["sankyo20"]
+   print ("output_midi")
+   print ("%10s %10s %10s" % ("events", "bytes", "seconds"))
+   rnd = random.Random (0)
+   fd, filename = tempfile.mkstemp (suffix=".mid")
+   os.close (fd)
+   try:
+      for n_notes in (5000, 10000, 20000, 40000, 80000):
+         notelist = [[] for i in model["notes"]]
+         for i in range (n_notes):
+            # include some delta times needing three and four vlq bytes
+            ticks = rnd.randrange (1 << rnd.choice ((12, 16, 24)))
+            notelist[rnd.randrange (len (notelist))].append (ticks)
+         notelist = [sorted (set (b)) for b in notelist]
+         dt = timeit (lambda: lamusica.output_midi (model, filename, notelist, 60, 480))
+         mi = check_midi_roundtrip (filename)
+         if len (mi.target) != sum ([len (b) for b in notelist]):
+            raise Exception ("MIDI round trip lost notes")
+         print ("%10d %10d %10.4f" % (2 * len (mi.target), os.path.getsize (filename), dt))
+   finally:
+      os.unlink (filename)
+
+
+def synth_bands (model, n_notes, seed=0, spacing=60):
+   # a long roll: n_notes holes distributed over the teeth of the model
+   rnd = random.Random (seed)
+   notelist = [[] for i in model["notes"]]
+   ticks = 0
+   for i in range (n_notes):
+      ticks += rnd.choice ((0, 0, spacing, 2 * spacing))
+      notelist[rnd.randrange (len (notelist))].append (ticks)
+   return [sorted (set (b)) for b in notelist]
+
+
+def bench_layout ():
+   model = lamusica.models["sankyo33"]
+   print ("Layout.strips (sankyo33, A4)")
+   print ("%10s %10s %10s" % ("holes", "strips", "seconds"))
+   for n_notes in (10000, 20000, 40000, 80000, 160000):
+      notelist = synth_bands (model, n_notes)
+      result = []
+      dt = timeit (lambda: result.append (lamusica.Layout (model, notelist, 60).strips (287)))
+      splits, strips = result[-1]
+      print ("%10d %10d %10.4f" % (sum ([len (s) for s in strips]), len (strips), dt))
+
+
+def bench_svg ():
+   # a long tune on sankyo20, native svg writer against cairo
+   model = lamusica.models["sankyo20"]
+   notelist = synth_bands (model, 40000, spacing=30)
+   plan = lamusica.Layout (model, notelist, 30).plan ("A4", 0, True)
+   fd, filename = tempfile.mkstemp (suffix=".svg")
+   os.close (fd)
+   print ("svg output, %d holes" % sum ([len (b) for b in notelist]))
+   print ("%-8s %10s %10s" % ("writer", "bytes", "seconds"))
+   try:
+      dt = timeit (lambda: lamusica.write_svg (plan, filename))
+      print ("%-8s %10d %10.4f" % ("native", os.path.getsize (filename), dt))
+      try:
+         import cairo
+      except ImportError:
+         print ("%-8s %10s" % ("cairo", "pycairo not installed"))
+      else:
+         dt = timeit (lambda: lamusica.draw_cairo (plan, filename, False))
+         print ("%-8s %10d %10.4f" % ("cairo", os.path.getsize (filename), dt))
+   finally:
+      os.unlink (filename)
+
+
+def bench_startup ():
+   # a short tune, so the interpreter and import costs dominate
+   script = os.path.join (os.path.dirname (os.path.abspath (__file__)), "lamusica.py")
+   tmpdir = tempfile.mkdtemp ()
+   midi = os.path.join (tmpdir, "tune.mid")
+   with open (midi, "wb") as f:
+      f.write (synth_midi ([synth_track (50)]))
+
+   runs = [("import only", [sys.executable, "-c", "import lamusica"]),
+           ("midi preview", [sys.executable, script, "--no-cache", "-m", os.path.join (tmpdir, "out.mid"), midi]),
+           ("pdf render", [sys.executable, script, "--no-cache", "-o", "0", "-p", os.path.join (tmpdir, "out.pdf"), midi])]
+
+   print ("startup time")
+   print ("%-14s %10s" % ("run", "seconds"))
+   try:
+      for name, cmd in runs:
+         def run ():
+            subprocess.run (cmd, cwd=os.path.dirname (script), check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+         try:
+            print ("%-14s %10.4f" % (name, timeit (run, 5)))
+         except subprocess.CalledProcessError:
+            print ("%-14s %10s" % (name, "failed"))
+   finally:
+      for f in os.listdir (tmpdir):
+         os.unlink (os.path.join (tmpdir, f))
+      os.rmdir (tmpdir)
+
+
+
+# scenarios for the pipeline benchmark: name, tracks, notes,
+# running status, meta/sysex every n notes, pitch range
+scenarios = [
+   ("small",      1,   2000, True,  200, (48, 96)),
+   ("tracks",     8,  20000, True,  200, (48, 96)),
+   ("no-running", 2,  20000, False, 200, (48, 96)),
+   ("meta-heavy", 2,  20000, True,    2, (48, 96)),
+   ("narrow",     2,  20000, True,  200, (60, 72)),
+   ("wide",       2,  20000, True,  200, (21, 109)),
+   ("long",       4, 100000, True,  200, (36, 96)),
+]
+
+
+def bench_pipeline (quick=False):
+   # times every stage of a conversion for every scenario and box,
+   # returns {"scenario/box/stage": seconds}, the box independent
+   # stages as "scenario/stage"
+   results = {}
+   tmpdir = tempfile.mkdtemp ()
+   midi = os.path.join (tmpdir, "tune.mid")
+   out = os.path.join (tmpdir, "out")
+   try:
+      import cairo
+   except ImportError:
+      cairo = None
+
+   print ("pipeline stages, seconds")
+   print ("%-12s %-9s %8s %8s %8s %8s %8s %8s %8s" % ("tune", "box", "parse", "filter",
+                                                      "transp.", "band", "midi", "svg", "pdf"))
+   try:
+      for name, tracks, notes, running, meta, pitches in scenarios:
+         if quick:
+            notes = notes // 10
+         data = synth_tune (tracks, notes, 0, running, meta, pitches)
+         with open (midi, "wb") as f:
+            f.write (data)
+
+         rolls = []
+         def parse ():
+            rolls.append (lamusica.PianoRoll ())
+            lamusica.MidiImporter (rolls[-1]).import_file (midi)
+         parse_t = timeit (parse)
+         roll = rolls[-1]
+         def filter ():
+            roll.filter_repetition (1)
+            return roll.min_repetition ()
+         filter_t = timeit (filter)
+         mindelta = filter ()
+
+         for box in sorted (lamusica.models):
+            model = lamusica.models[box]
+            available = model["pitches"]
+            times = { "parse" : parse_t, "filter" : filter_t }
+
+            def transpose ():
+               roll.invalidate ()
+               return roll.find_transpose (available, verbose=False)
+            times["transpose"] = timeit (transpose)
+            roll.transpose = [ transpose () ]
+
+            notelist = []
+            times["band"] = timeit (lambda: notelist.append (roll.get_compat_band (model)))
+            notelist = notelist[-1]
+            times["midi"] = timeit (lambda: lamusica.output_midi (model, out, notelist,
+                                                                  mindelta, roll.timediv))
+            with open (os.devnull, "w") as devnull, contextlib.redirect_stderr (devnull):
+               # a fresh layout every time, the cut plans are cached in it
+               layout = lambda: lamusica.Layout (model, notelist, mindelta)
+               times["svg"] = timeit (lambda: lamusica.output_file (layout (), out, False,
+                                                                    "A4", 0, True))
+               if cairo:
+                  times["pdf"] = timeit (lambda: lamusica.output_file (layout (), out, True,
+                                                                       "A4", 0))
+
+            print ("%-12s %-9s" % (name, box) +
+                   "".join ([" %8.4f" % times[s] if s in times else " %8s" % "-"
+                             for s in ("parse", "filter", "transpose", "band",
+                                       "midi", "svg", "pdf")]))
+            for stage, dt in times.items ():
+               # parsing and filtering do not depend on the box
+               if stage in ("parse", "filter"):
+                  results["%s/%s" % (name, stage)] = dt
+               else:
+                  results["%s/%s/%s" % (name, box, stage)] = dt
+   finally:
+      for f in os.listdir (tmpdir):
+         os.unlink (os.path.join (tmpdir, f))
+      os.rmdir (tmpdir)
+
+   return results
+
+
+def compare_baseline (results, baseline, threshold):
+   # prints every timing that got slower than threshold * baseline,
+   # returns the number of regressions
+   regressions = 0
+   print ("regressions against baseline (threshold %.2f)" % threshold)
+   for key in sorted (results):
+      if key not in baseline["results"]:
+         continue
+      old, new = baseline["results"][key], results[key]
+      # very short stages are too noisy to compare
+      if new > max (old, 0.005) * threshold:
+         print ("  %-36s %10.4f -> %10.4f (%.2fx)" % (key, old, new, new / max (old, 1e-9)))
+         regressions += 1
+   if not regressions:
+      print ("  none")
+   return regressions
+
+
+def usage ():
+   print ("Usage: %s [arguments]" % sys.argv[0], file=sys.stderr)
+   print ("  -h, --help: show usage", file=sys.stderr)
+   print ("  -q, --quick: pipeline benchmark with a tenth of the notes only", file=sys.stderr)
+   print ("  -P, --pipeline-only: skip the micro benchmarks", file=sys.stderr)
+   print ("  -o, --output=filename: write the pipeline timings as JSON", file=sys.stderr)
+   print ("  -c, --compare=filename: compare the pipeline timings with a JSON baseline", file=sys.stderr)
+   print ("  -t, --threshold=factor: slowdown reported as regression (default 1.25)", file=sys.stderr)
+
+
+
+if __name__=='__main__':
+   try:
+      opts, args = getopt.getopt (sys.argv[1:], "hqPo:c:t:",
+                                  ["help", "quick", "pipeline-only",
+                                   "output=", "compare=", "threshold="])
+   except getopt.GetoptError as err:
+      usage ()
+      sys.exit (2)
+
+   quick = False
+   micro = True
+   output = None
+   baseline = None
+   threshold = 1.25
+   for o, a in opts:
+      if o in ("-h", "--help"):
+         usage ()
+         sys.exit ()
+      elif o in ("-q", "--quick"):
+         quick = True
+      elif o in ("-P", "--pipeline-only"):
+         micro = False
+      elif o in ("-o", "--output"):
+         output = a
+      elif o in ("-c", "--compare"):
+         with open (a) as f:
+            baseline = json.load (f)
+      elif o in ("-t", "--threshold"):
+         threshold = float (a)
+
+   if micro:
+      bench_parse ()
+      bench_midi_writer ()
+      bench_layout ()
+      bench_svg ()
+      bench_startup ()
+
+   results = bench_pipeline (quick)
+   if output:
+      with open (output, "w") as f:
+         json.dump ({ "python"  : platform.python_version (),
+                      "machine" : platform.machine (),
+                      "quick"   : quick,
+                      "results" : results }, f, indent=1, sort_keys=True)
+
+   if baseline and compare_baseline (results, baseline, threshold):
+      sys.exit (1)
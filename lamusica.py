@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 # (c) 2011-2017 Simon Budig <simon@budig.de>
 
-import sys, struct, math, getopt
-import cairo
+import sys, os, struct, math, time, getopt, glob
+import hashlib, pickle, tempfile, contextlib, json, stat
+import bisect, heapq, itertools, mmap
+from array import array
 
 # Mensch macht bequem ca. 120-180 UPM.
 
-delta_ticks = 0
-
-models = {
+# the built-in boxes, more are read from json files (see load_models)
+builtin_models = {
    # https://www.spieluhr.de/Artikel/varAussehen.asp?ArtikelNr=4905
    "china15" : {
       # Gis Dur? SRSLY?
@@ -26,6 +27,7 @@ models = {
       "distance" :  2.0,
       "diameter" :  1.8,
       "step"     :  8.0,
+      "restrike" :  4.0,     # mm, closest holes on one tooth
       "speed"    :  300./49,     # mm/U
    },
    # https://www.spieluhr.de/Artikel/varAussehen.asp?ArtikelNr=4972
@@ -43,6 +45,7 @@ models = {
       "distance" :  3.0,
       "diameter" :  2.4,
       "step"     :  7.0,
+      "restrike" :  3.5,
       "speed"    :  300./53,
    },
    # http://www.njdean.co.uk/musical-movements-mbm30hp.htm
@@ -66,6 +69,7 @@ models = {
       "distance" :  2.0,
       "diameter" :  1.8,
       "step"     :  7.25,
+      "restrike" :  3.6,
       "speed"    :  300./45.5,
    },
    # http://www.leturlutain.fr/index.php?item=33-notes-sankyo-music-box&action=article&group_id=10000033&aid=5796&lang=EN
@@ -84,32 +88,745 @@ models = {
       "distance" :  1.8,
       "diameter" :  1.7,
       "step"     :  8.0,
+      "restrike" :  4.0,
       "speed"    :  600./106,
    }
 }
 
 
-def sort_coords (coords):
-   return coords
+class Stats (object):
+   # wall clock time per pipeline stage and event counters of one job.
+   # Diagnostic output only shows up when verbose.
+   def __init__ (self, verbose=False):
+      self.verbose = verbose
+      self.timers = {}
+      self.counters = {}
+
+
+   @contextlib.contextmanager
+   def timer (self, stage):
+      t0 = time.perf_counter ()
+      try:
+         yield
+      finally:
+         self.timers[stage] = self.timers.get (stage, 0.0) + time.perf_counter () - t0
+
+
+   def count (self, name, n=1):
+      self.counters[name] = self.counters.get (name, 0) + n
+
+
+   def log (self, *args):
+      if self.verbose:
+         print (*args, file=sys.stderr)
+
+
+   def merge (self, other):
+      for k, v in other["timers"].items ():
+         self.timers[k] = self.timers.get (k, 0.0) + v
+      for k, v in other["counters"].items ():
+         self.count (k, v)
+
+
+   def as_dict (self):
+      return { "timers" : dict (self.timers), "counters" : dict (self.counters) }
+
+
+   def report (self, format="text", out=None):
+      # json goes to stdout for further processing, text to stderr
+      if format == "json":
+         out = out or sys.stdout
+         json.dump (self.as_dict (), out, indent=1, sort_keys=True)
+         print (file=out)
+         return
+      out = out or sys.stderr
+      for k in sorted (self.timers):
+         print ("%-24s %10.4f s" % (k, self.timers[k]), file=out)
+      for k in sorted (self.counters):
+         print ("%-24s %10s" % (k, self.counters[k]), file=out)
+
+
+def fold_table (model):
+   # maps each midi note to the teeth playing it. Notes missing on the
+   # comb are folded by octaves onto the nearest tooth of the same pitch.
+   notes = [n + model["lowest"] for n in model["notes"]]
+   table = [[] for i in range (128)]
+   for i in range (len (notes)):
+      source_notes = [notes[i]]
+      n = notes[i] - 12
+      while n >= 0 and n not in notes:
+         source_notes.append (n)
+         n -= 12
+      n = notes[i] + 12
+      while n <= 127 and  n not in notes:
+         source_notes.append (n)
+         n += 12
+
+      for n in source_notes:
+         if 0 <= n <= 127:
+            table[n].append (i)
+
+   return tuple ([tuple (t) for t in table])
+
+
+class Model (object):
+   # a validated box definition and the values derived from it, computed
+   # once and shared by all stages. Read-only, model["step"] works like
+   # with the plain definitions.
+   fields = ("lowest", "notes", "program", "height", "offset", "distance",
+             "diameter", "step", "restrike", "speed")
+   __slots__ = ("name",) + fields + ("pitches", "playable", "folds", "ys", "radius")
+
+   def __init__ (self, name, definition):
+      missing = [k for k in self.fields if k not in definition]
+      if missing:
+         raise Exception ("box %s: %s missing" % (name, ", ".join (missing)))
+      notes = definition["notes"]
+      if (not notes or not all ([isinstance (n, int) for n in notes]) or
+          not isinstance (definition["lowest"], int)):
+         raise Exception ("box %s: lowest and the notes need to be integers" % name)
+      if any ([n1 <= n0 for n0, n1 in zip (notes, notes[1:])]):
+         raise Exception ("box %s: teeth are not strictly increasing" % name)
+      if not 0 <= definition["lowest"] + notes[0] <= definition["lowest"] + notes[-1] <= 127:
+         raise Exception ("box %s: notes outside the midi range" % name)
+      if not isinstance (definition["program"], int) or not 0 <= definition["program"] <= 127:
+         raise Exception ("box %s: program is not a midi program (0-127)" % name)
+      for k in self.fields[3:]:
+         if not isinstance (definition[k], (int, float)):
+            raise Exception ("box %s: %s is not a number" % (name, k))
+      if definition["offset"] < 0:
+         raise Exception ("box %s: offset is negative" % name)
+      for k in ("height", "distance", "diameter", "step", "restrike", "speed"):
+         if definition[k] <= 0:
+            raise Exception ("box %s: %s is not a positive number" % (name, k))
+      if definition["offset"] + (len (notes) - 1) * definition["distance"] > definition["height"]:
+         raise Exception ("box %s: %d teeth do not fit on a %.1f mm strip" %
+                          (name, len (notes), definition["height"]))
+
+      init = lambda k, v: object.__setattr__ (self, k, v)
+      init ("name", name)
+      for k in self.fields:
+         init (k, definition[k])
+      init ("notes", tuple (notes))
+      init ("pitches", tuple ([n + self.lowest for n in notes]))
+      init ("playable", tuple ([n in self.pitches for n in range (128)]))
+      init ("folds", fold_table (self))
+      init ("ys", tuple ([i * self.distance + self.offset for i in range (len (notes))]))
+      init ("radius", self.diameter / 2)
+
+
+   def __getitem__ (self, key):
+      if key not in self.__slots__:
+         raise KeyError (key)
+      return getattr (self, key)
+
+
+   def __setattr__ (self, key, value):
+      raise AttributeError ("box %s is read-only" % self.name)
+
+
+   def __reduce__ (self):
+      return (Model, (self.name, dict ([(k, getattr (self, k)) for k in self.fields])))
+
+
+def default_model_dirs ():
+   # $LAMUSICA_BOXES is a list of directories like $PATH
+   if os.environ.get ("LAMUSICA_BOXES"):
+      return os.environ["LAMUSICA_BOXES"].split (os.pathsep)
+   base = os.environ.get ("XDG_CONFIG_HOME") or os.path.join (os.path.expanduser ("~"), ".config")
+   return [os.path.join (base, "lamusica", "boxes")]
+
+
+def load_models (definitions, directories=[]):
+   # the boxes of the definitions and of the json files in the
+   # directories, each file maps box names to definitions like
+   # builtin_models. Later boxes replace earlier ones of the same name,
+   # broken ones are reported and left out.
+   models = dict ([(name, Model (name, d)) for name, d in definitions.items ()])
+   for filename in [f for d in directories for f in sorted (glob.glob (os.path.join (d, "*.json")))]:
+      try:
+         with open (filename) as f:
+            boxes = list (json.load (f).items ())
+      except Exception as e:
+         print ("%s: %s" % (filename, e), file=sys.stderr)
+         continue
+      # a broken box does not drop the others of the file
+      for name, d in boxes:
+         try:
+            models[name] = Model (name, d)
+         except Exception as e:
+            print ("%s: %s" % (filename, e), file=sys.stderr)
+   return models
+
+
+# only the built-in boxes on import, the command line adds the box
+# files (see __main__)
+models = load_models (builtin_models)
+
+
+def use_models (registry):
+   # initializer of worker processes, which may not be forked from the
+   # process that read the box files
+   registry = dict (registry)
+   models.clear ()
+   models.update (registry)
+
+
+def restrike_ticks (model, mindelta):
+   # the closest two holes on one tooth may be, in ticks of a strip
+   # scaled for mindelta
+   return model["restrike"] * mindelta / model["step"]
+
+
+def tooth_collisions (notelist, limit):
+   # all pairs of holes on the same tooth less than limit ticks apart,
+   # as (tooth, t0, t1). The bands are sorted, the holes following a
+   # hole within the limit are found by bisection.
+   collisions = []
+   for i, band in enumerate (notelist):
+      for j, t0 in enumerate (band):
+         end = bisect.bisect_left (band, t0 + limit, j + 1)
+         collisions += [(i, t0, t1) for t1 in band[j+1:end]]
+   return collisions
+
+
+def resolve_collisions (notelist, model, limit, strategy):
+   # returns bands without collisions and the number of holes changed.
+   # The later hole of a collision is dropped, delayed up to the limit
+   # ("nudge") or moved to a free tooth an octave away ("refold"),
+   # holes that cannot be nudged or refolded are dropped.
+   notes = model["pitches"]
+   bands = [list (b) for b in notelist]
+   counts = { "dropped" : 0, "nudged" : 0, "refolded" : 0 }
+
+   def free (j, t):
+      k = bisect.bisect_left (bands[j], t)
+      return ((k == len (bands[j]) or bands[j][k] - t >= limit) and
+              (k == 0 or t - bands[j][k-1] >= limit))
+
+   for i in range (len (bands)):
+      band = bands[i]
+      kept = []
+      octaves = sorted ([j for j in range (len (notes))
+                         if j != i and (notes[j] - notes[i]) % 12 == 0],
+                        key=lambda j: abs (notes[j] - notes[i]))
+      for k, t in enumerate (band):
+         if not kept or t - kept[-1] >= limit:
+            kept.append (t)
+            continue
 
-   dists = {}
-   for a in range (len (coords)):
-      for b in range (a):
-         dists[(b, a)] = ((coords[a][0] - coords[b][0])**2 + (coords[a][1] - coords[b][1])**2)**0.5
+         if strategy == "nudge":
+            t1 = int (math.ceil (kept[-1] + limit))
+            if t1 - t <= limit and (k + 1 == len (band) or band[k+1] - t1 >= limit):
+               kept.append (t1)
+               counts["nudged"] += 1
+               continue
+         elif strategy == "refold":
+            others = [j for j in octaves if free (j, t)]
+            if others:
+               bisect.insort (bands[others[0]], t)
+               counts["refolded"] += 1
+               continue
+         counts["dropped"] += 1
+      bands[i] = kept
+
+   return bands, counts
+
+
+def worst_passages (collisions, window, n=5):
+   # the windows of window ticks with the most collisions, as
+   # (start tick, collisions, teeth)
+   passages = {}
+   for tooth, t0, t1 in collisions:
+      w = t0 - t0 % window
+      count, teeth = passages.get (w, (0, set ()))
+      passages[w] = (count + 1, teeth | { tooth })
+   worst = sorted (passages.items (), key=lambda p: (-p[1][0], p[0]))[:n]
+   return [(w, count, sorted (teeth)) for w, (count, teeth) in worst]
+
+
+def path_length (coords, start=None):
+   length = 0.0
+   for p in coords:
+      if start is not None:
+         length += math.hypot (p[0] - start[0], p[1] - start[1])
+      start = p
+   return length
+
+
+class PointGrid (object):
+   # bucket grid for nearest neighbour queries on hole coordinates
+   def __init__ (self, coords):
+      self.coords = coords
+      xs = [p[0] for p in coords]
+      ys = [p[1] for p in coords]
+      self.x0 = min (xs)
+      self.y0 = min (ys)
+      area = (max (xs) - self.x0 + 1.0) * (max (ys) - self.y0 + 1.0)
+      self.cell = math.sqrt (area / len (coords)) * 2
+      self.cells = {}
+      for i in range (len (coords)):
+         self.cells.setdefault (self.key (coords[i]), set ()).add (i)
+      self.maxring = max ([max (abs (k[0]), abs (k[1])) for k in self.cells]) + 1
+
+
+   def key (self, p):
+      return (int ((p[0] - self.x0) // self.cell),
+              int ((p[1] - self.y0) // self.cell))
+
+
+   def remove (self, i):
+      self.cells[self.key (self.coords[i])].discard (i)
+
+
+   def nearest (self, p, k, exclude=-1):
+      # points in ring r+1 and beyond are at least r cells away
+      cx, cy = self.key (p)
+      found = []
+      r = 0
+      while r <= self.maxring + max (abs (cx), abs (cy)):
+         for gx in range (cx - r, cx + r + 1):
+            for gy in ((cy - r, cy + r) if abs (gx - cx) != r
+                       else range (cy - r, cy + r + 1)):
+               for j in self.cells.get ((gx, gy), ()):
+                  if j != exclude:
+                     q = self.coords[j]
+                     found.append ((math.hypot (q[0] - p[0], q[1] - p[1]), j))
+         if len (found) >= k:
+            found.sort ()
+            if found[k-1][0] <= r * self.cell:
+               break
+         r += 1
+      found.sort ()
+      return [j for d, j in found[:k]]
+
+
+# candidate moves tried by sort_coords per second of --optimize, about
+# the speed of a typical machine. Counting moves instead of measuring the
+# time keeps the output independent of the machine and its load.
+optimize_rate = 500000
+
+def sort_coords (coords, start=None, budget=1.0):
+   # orders the holes for the laser head: a greedy nearest neighbour
+   # path from start, improved by 2-opt and or-opt moves between
+   # neighbouring holes until nothing improves or the budget is used.
+   limit = budget * optimize_rate
+   if len (coords) < 3 or budget <= 0:
+      return list (coords)
+
+   # point 0 is the fixed start of the path
+   pts = [start if start is not None else coords[0]] + list (coords)
+   n = len (pts)
+   grid = PointGrid (pts)
+
+   def d (a, b):
+      return math.hypot (pts[a][0] - pts[b][0], pts[a][1] - pts[b][1])
+
+   tour = [0]
+   grid.remove (0)
+   for i in range (1, n):
+      j = grid.nearest (pts[tour[-1]], 1)[0]
+      grid.remove (j)
+      tour.append (j)
+
+   grid = PointGrid (pts)
+   neighbours = {}
+   def neigh (a):
+      if a not in neighbours:
+         neighbours[a] = grid.nearest (pts[a], 8, a)
+      return neighbours[a]
+
+   pos = [0] * n
+   for i in range (n):
+      pos[tour[i]] = i
+
+   def reverse (i, j):
+      tour[i:j+1] = tour[i:j+1][::-1]
+      for k in range (i, j + 1):
+         pos[tour[k]] = k
+
+   tried = 0
+   improved = True
+   while improved and tried < limit:
+      improved = False
+
+      # 2-opt: make a and one of its neighbours c adjacent
+      for i in range (1, n):
+         if i % 64 == 0 and tried > limit:
+            break
+         a = tour[i]
+         tried += len (neigh (a))
+         for c in neigh (a):
+            j = pos[c]
+            if j > i + 1:
+               b = tour[i+1]
+               gain = d (a, b) - d (a, c)
+               if j + 1 < n:
+                  e = tour[j+1]
+                  gain += d (c, e) - d (b, e)
+               if gain > 1e-9:
+                  reverse (i + 1, j)
+                  improved = True
+                  break
+            elif 1 <= j < i - 1:
+               b = tour[i-1]
+               p = tour[j-1]
+               gain = d (p, c) + d (b, a) - d (p, b) - d (c, a)
+               if gain > 1e-9:
+                  reverse (j, i - 1)
+                  improved = True
+                  break
+
+      # or-opt: move a run of up to three holes next to a neighbour
+      for l in (1, 2, 3):
+         i = 1
+         while i + l <= n:
+            if i % 64 == 0 and tried > limit:
+               break
+            s0, s1 = tour[i], tour[i+l-1]
+            p = tour[i-1]
+            nx = tour[i+l] if i + l < n else None
+            removed = d (p, s0)
+            if nx is not None:
+               removed += d (s1, nx) - d (p, nx)
+            best = None
+            tried += len (neigh (s0)) + len (neigh (s1))
+            for c in neigh (s0) + neigh (s1):
+               k = pos[c]
+               if i - 1 <= k < i + l:
+                  continue
+               b = tour[k+1] if k + 1 < n else None
+               if b is None:
+                  fwd, rev = d (c, s0), d (c, s1)
+               else:
+                  fwd = d (c, s0) + d (s1, b) - d (c, b)
+                  rev = d (c, s1) + d (s0, b) - d (c, b)
+               if removed - min (fwd, rev) > 1e-9 and (best is None or min (fwd, rev) < best[0]):
+                  best = (min (fwd, rev), c, rev < fwd)
+            if best:
+               cost, c, flip = best
+               segment = tour[i:i+l]
+               if flip:
+                  segment.reverse ()
+               del tour[i:i+l]
+               k = pos[c] if pos[c] < i else pos[c] - l
+               tour[k+1:k+1] = segment
+               for k in range (min (k, i - 1), n):
+                  pos[tour[k]] = k
+               improved = True
+            i += 1
+
+   result = [pts[i] for i in tour[1:]]
+   if path_length (result, pts[0]) < path_length (coords, pts[0]):
+      return result
+   return list (coords)
+
+
+# blank paper before the first and after the last hole
+leadin  = 30.0
+leadout = 30.0
+
+class Layout (object):
+   # the hole positions of a tune on a box model, computed once. The
+   # strip splits and the cut plans are cached per strip width, so any
+   # number of backends and paper sizes share the work.
+   def __init__ (self, model, notelist, mindelta, strip_cache=None):
+      self.model = model
+      self.strip_cache = strip_cache
+      self.radius = model["radius"]
+      self.step = model["step"] / mindelta
+      ys      = model["ys"]
+      step    = self.step
+
+      # the bands are sorted already, everything is done by merging them
+      self.times = [t for t, g in itertools.groupby (heapq.merge (*notelist))]
+      start   = self.times[0]
+      end     = self.times[-1]
+      self.length = int (end - start) * step + self.radius * 2 + leadin + leadout
+
+      self.holes = list (heapq.merge (*[[(leadin + (n - start) * step, ys[i])
+                                         for n in notelist[i]]
+                                        for i in range (len (notelist))]))
+      self.xs = [h[0] for h in self.holes]
+      self._strips = {}
+      self._cuts = {}
+      self._packs = {}
+      self._breaks = None
+
+
+   def strips (self, strip_maxwidth):
+      # returns the strip boundaries and the holes (sorted by x, y) of
+      # every strip.
+      if strip_maxwidth in self._strips:
+         return self._strips[strip_maxwidth]
+
+      alltimes = self.times
+      step = self.step
+      splits = [0.0]
+      startpos = splits[0]
+      breakpos = splits[0]
+
+      for i in range (1, len(alltimes)):
+         middlepos = leadin + (alltimes[i] + alltimes[i-1]) * step / 2
+         if middlepos - startpos > strip_maxwidth:
+            splits.append (breakpos)
+            startpos = breakpos
+
+         if (alltimes[i] - alltimes[i-1]) * step > self.radius * 4:
+            breakpos = middlepos
+
+      splits.append (self.length)
+
+      self._strips[strip_maxwidth] = splits, self.split_holes (splits)
+      return self._strips[strip_maxwidth]
+
+
+   def split_holes (self, splits):
+      strips = []
+      first = 0
+      for x1 in splits[1:]:
+         last = bisect.bisect_left (self.xs, x1, first)
+         strips.append (self.holes[first:last])
+         first = last
+      return strips
+
+
+   def breaks (self):
+      # the possible strip breaks: the middle of the gaps wider than
+      # two holes, relative to the first note like the holes
+      if self._breaks is None:
+         t = self.times
+         self._breaks = [leadin + ((t[i] + t[i-1]) / 2 - t[0]) * self.step
+                         for i in range (1, len (t))
+                         if (t[i] - t[i-1]) * self.step > self.radius * 4]
+      return self._breaks
+
+
+   def pack (self, strip_maxwidth, gap, quality=1):
+      # returns the splits and the rows of strip numbers of a packing
+      # with as few rows as possible, see pack_ordered() and pack_ffd().
+      # quality 1 keeps the strips in order, quality 2 also tries to
+      # reorder the greedy and the packed strips and keeps the best.
+      key = (strip_maxwidth, gap, quality)
+      if key in self._packs:
+         return self._packs[key]
+
+      splits = pack_ordered (self.breaks (), self.length, strip_maxwidth, gap)
+      candidates = [(splits, pack_next_fit (splits, strip_maxwidth, gap))]
+      if quality >= 2:
+         for s in (splits, self.strips (strip_maxwidth)[0]):
+            # the last greedy strip may be wider with the lead-out
+            if max ([b - a for a, b in zip (s, s[1:])]) <= strip_maxwidth:
+               candidates.append ((s, pack_ffd (s, strip_maxwidth, gap)))
+
+      # fewest rows, then fewest strips, the ordered packing wins ties
+      best = min (candidates, key=lambda c: (len (c[1]), len (c[0])))
+      self._packs[key] = best
+      return best
+
+
+   def cuts (self, splits, p_x0, optimize=0, pool=None, stats=None):
+      # the cut plans of all strips at y = 0, the strips are independent
+      # and with an executor pool planned in parallel.
+      key = (tuple (splits), p_x0, optimize)
+      if key in self._cuts:
+         return self._cuts[key]
+
+      strips = self.split_holes (splits)
+      n_holes = max (sum ([len (h) for h in strips]), 1)
+      args = list (zip (strips, splits, splits[1:], [p_x0] * len (strips),
+                        [0] * len (strips),
+                        [optimize * len (h) / n_holes for h in strips]))
+      cuts = [None] * len (args)
+
+      # in incremental mode the optimized strips are looked up by their
+      # holes and geometry, only the changed ones are planned again
+      cache = self.strip_cache if optimize > 0 else None
+      if cache:
+         keys = [cache.key (a[:5], a[5]) for a in args]
+         cuts = [cache.load (k) for k in keys]
+
+      todo = [i for i in range (len (args)) if cuts[i] is None]
+      if stats and cache:
+         stats.count ("strip cache hit", len (args) - len (todo))
+         stats.count ("strip cache miss", len (todo))
+
+      if todo:
+         todo_args = zip (*[args[i] for i in todo])
+         if pool and optimize > 0 and len (todo) > 1:
+            done = pool.map (strip_cuts, *todo_args)
+         else:
+            done = map (strip_cuts, *todo_args)
+         for i, c in zip (todo, done):
+            cuts[i] = c
+            if cache:
+               cache.store (keys[i], c, False)
+         if cache:
+            cache.evict ()
+
+      self._cuts[key] = cuts
+      return cuts
+
+
+   def plan (self, papersize, optimize=0, single_page=False, stats=None,
+             pool=None, pack=0):
+      # places the strips on the pages of the given size, one strip per
+      # row or with pack > 0 several strips per row, see pack(), and
+      # the paper turned if that needs fewer pages.
+      height  = self.model["height"]
+      pwidth, pheight, p_x0, p_y0, pgap = page_geometry (papersize, height)
+
+      strip_maxwidth  = pwidth  - 2 * p_x0
+
+      if pack:
+         # the paper may be turned, whichever needs fewer pages
+         choices = []
+         for w, h in ((pwidth, pheight), (pheight, pwidth))[:1 if single_page else 2]:
+            if h - 2 * p_y0 < height:
+               continue
+            splits, rows = self.pack (w - 2 * p_x0, pgap, pack)
+            per_page = max (int ((h - 2 * p_y0 - height) // (height + pgap)) + 1, 1)
+            choices.append ((-(-len (rows) // per_page), w, h, splits, rows))
+         pages, pwidth, pheight, splits, rows = min (choices, key=lambda c: c[0])
+      else:
+         splits = self.strips (strip_maxwidth)[0]
+         rows = [[i] for i in range (len (splits) - 1)]
+      if stats:
+         stats.log (splits)
+
+      if single_page:
+         pheight = (len (rows) + 1) * (height + pgap) - pgap + 2 * p_y0
+
+      plan = { "width"  : pwidth,
+               "height" : pheight,
+               "x0"     : p_x0,
+               "y0"     : p_y0,
+               "radius" : self.radius,
+               "strips" : [],
+               "pages"  : 1,
+               "travel" : [0.0, 0.0] }
+
+      cuts = self.cuts (splits, p_x0, optimize, pool, stats)
+
+      y0 = max (p_y0, pgap)
+      y1 = y0 + height
 
-   # sortieren: ähnlich minimal tree, nur Verlängern an Ende
-   # 2nd pass: Punkte einzeln hinzufügen und nach Dreickesungleichung vorher suchen
+      for row in rows:
+         xl = p_x0
+         for i in row:
+            c, travel = cuts[i]
+            dx = xl - p_x0
+            strip = { "x0"         : xl,
+                      "y0"         : y0,
+                      "y1"         : y1,
+                      "x1"         : xl + splits[i+1] - splits[i],
+                      "cuts"       : [(k, a + dx, b + y0) if k == "hole" else (k, a + dx, b + dx)
+                                      for k, a, b in c],
+                      "page_break" : False }
+            if pack:
+               strip["label"] = i + 1
+            plan["strips"].append (strip)
+            plan["travel"][0] += travel[0]
+            plan["travel"][1] += travel[1]
+            xl = strip["x1"] + pgap
+
+         y0 = y1 + pgap
+         if y0 + height + p_y0 > pheight:
+            y0 = p_y0
+            strip["page_break"] = True
+            plan["pages"] += 1
+         y1 = y0 + height
+
+      if plan["strips"] and plan["strips"][-1]["page_break"]:
+         plan["pages"] -= 1
+
+      return plan
+
+
+def pack_ordered (breaks, length, width, gap):
+   # chooses the strip splits among the breaks, so that the strips put
+   # next to each other (gap apart) into rows of the given width, in
+   # order, need as few rows as possible. Dynamic programming over the
+   # breaks, the best state at a break is the least (rows, fill of the
+   # last row, strips): any continuation of it needs no more rows.
+   points = [0.0] + breaks + [length]
+   best = [(0, sys.maxsize, 0)] + [None] * (len (points) - 1)
+   back = [0] * len (points)
+   lo = 0
+   for j in range (1, len (points)):
+      while points[j] - points[lo] > width:
+         lo += 1
+      # a gap-free passage longer than a row still has to be one strip
+      for i in range (min (lo, j - 1), j):
+         rows, fill, n = best[i]
+         w = points[j] - points[i]
+         if fill + gap + w <= width:
+            state = (rows, fill + gap + w, n + 1)
+         else:
+            state = (rows + 1, w, n + 1)
+         if best[j] is None or state < best[j]:
+            best[j] = state
+            back[j] = i
+
+   splits = [points[-1]]
+   j = len (points) - 1
+   while j > 0:
+      j = back[j]
+      splits.append (points[j])
+   return splits[::-1]
+
+
+def pack_next_fit (splits, width, gap):
+   # the strips in order, the next one goes into the current row if it
+   # fits, returns the rows as lists of strip numbers
+   rows = []
+   fill = sys.maxsize
+   for i in range (len (splits) - 1):
+      w = splits[i+1] - splits[i]
+      if fill + gap + w <= width:
+         rows[-1].append (i)
+         fill += gap + w
+      else:
+         rows.append ([i])
+         fill = w
+   return rows
+
+
+def pack_ffd (splits, width, gap):
+   # first fit decreasing: the widest strips first, each one into the
+   # first row with room for it. The strips of a row and the rows are
+   # sorted by strip number again.
+   widths = [x1 - x0 for x0, x1 in zip (splits, splits[1:])]
+   rows = []
+   free = []
+   for i in sorted (range (len (widths)), key=lambda i: -widths[i]):
+      for r in range (len (rows)):
+         if free[r] >= gap + widths[i]:
+            rows[r].append (i)
+            free[r] -= gap + widths[i]
+            break
+      else:
+         rows.append ([i])
+         free.append (width - widths[i])
+   return sorted ([sorted (r) for r in rows])
 
 
-def output_file (model, filename, is_pdf, notelist, mindelta, papersize):
-   papersizes = {
-      "A4": (297, 210, 5, 5),
-      "A3": (420, 297, 5, 5),
-   }
+papersizes = {
+   "A4": (297, 210, 5, 5),
+   "A3": (420, 297, 5, 5),
+}
 
+def page_geometry (papersize, height=0):
+   # height is the strip height that needs to fit on a custom size
    if papersize in papersizes:
       pwidth, pheight, p_x0, p_y0 = papersizes[papersize]
       pgap = 2
+   elif "x" in papersize:
+      # custom size in mm, e.g. 600x400
+      pwidth, pheight = [float (s) for s in papersize.split ("x")]
+      p_x0 = 5
+      p_y0 = 5
+      pgap = 2
    else:
       pwidth  = 700.0
       pheight = 500.0
@@ -120,41 +837,85 @@ def output_file (model, filename, is_pdf, notelist, mindelta, papersize):
    p_x0 = max (p_x0, pgap)
    p_y0 = max (p_y0, pgap)
 
-   strip_maxwidth  = pwidth  - 2 * p_x0
-   strip_maxheight = pheight - 2 * p_y0
-
-   height  = model["height"]
-   offset  = model["offset"]
-   radius  = model["diameter"] / 2
-   dist    = model["distance"]
-   step    = model["step"] / mindelta
-   leadin  = 30.0
-   leadout = 30.0
-
-   alltimes = list (set (sum (notelist, [])))
-   alltimes.sort ()
-   start   = alltimes[0]
-   end     = alltimes[-1]
-   length  = int (end - start) * step + radius * 2 + leadin + leadout
-
-   splits = [0.0]
-   startpos = splits[0]
-   breakpos = splits[0]
-
-   for i in range (1, len(alltimes)):
-      middlepos = leadin + (alltimes[i] + alltimes[i-1]) * step / 2
-      if middlepos - startpos > strip_maxwidth:
-         splits.append (breakpos)
-         startpos = breakpos
-
-      if (alltimes[i] - alltimes[i-1]) * step > radius * 4:
-         breakpos = middlepos
-
-   splits.append (length)
-   print (splits)
-
-   holes = [(leadin + (n - start) * step, i * dist + offset) for i in range (len (notelist)) for n in notelist[i]]
-   holes.sort ()
+   if not (math.isfinite (pwidth) and math.isfinite (pheight) and
+           pwidth > 2 * p_x0 and pheight >= 2 * p_y0 + height):
+      raise ValueError ("paper %s is too small" % papersize)
+
+   return pwidth, pheight, p_x0, p_y0, pgap
+
+
+def strip_cuts (holes, x0, x1, p_x0, y0, budget):
+   # returns the cut sequence of a strip in page coordinates:
+   # ("hole", x, y) and ("border", from, to) for the top and bottom edge,
+   # and the laser travel [in time order, optimized] of its holes.
+   # The holes are cut in sections, after each section the strip border
+   # is cut up to its last hole.
+   sections = []
+   section = []
+   border_end = p_x0;
+   for x, y in holes:
+      section.append ((x, y))
+      if x - x0 + p_x0 - border_end >= 50:
+         border_end = x - x0 + p_x0
+         sections.append ((section, border_end))
+         section = []
+   sections.append ((section, None))
+
+   cuts = []
+   travel = [0.0, 0.0]
+   border_end = p_x0;
+   head = head_unsorted = None
+   for section, border in sections:
+      if section:
+         travel[0] += path_length (section, head_unsorted)
+         head_unsorted = section[-1]
+         if budget > 0:
+            section = sort_coords (section, head, budget * len (section) / len (holes))
+         travel[1] += path_length (section, head)
+         head = section[-1]
+
+      for x, y in section:
+         cuts.append (("hole", x - x0 + p_x0, y + y0))
+
+      if border is not None:
+         cuts.append (("border", border_end, border))
+         border_end = border
+
+   if border_end < x1:
+      cuts.append (("border", border_end, x1 - x0 + p_x0))
+
+   return cuts, travel
+
+
+def split_pages (plan):
+   # one plan per page, e.g. for writing every page to its own file
+   pages = []
+   strips = []
+   for strip in plan["strips"]:
+      strips.append (dict (strip, page_break=False))
+      if strip["page_break"]:
+         pages.append (dict (plan, strips=strips))
+         strips = []
+   if strips:
+      pages.append (dict (plan, strips=strips))
+   return pages
+
+
+def page_filename (filename, page):
+   # tune.svg -> tune-1.svg
+   base, ext = os.path.splitext (filename)
+   return "%s-%d%s" % (base, page, ext)
+
+
+def draw_cairo (plan, filename, is_pdf):
+   # pycairo is only needed when rendering
+   import cairo
+
+   pwidth  = plan["width"]
+   pheight = plan["height"]
+   p_x0    = plan["x0"]
+   p_y0    = plan["y0"]
+   radius  = plan["radius"]
 
    if is_pdf:
       surface = cairo.PDFSurface (filename,
@@ -162,7 +923,6 @@ def output_file (model, filename, is_pdf, notelist, mindelta, papersize):
                                   pheight / 25.4 * 72)
    else:
       # cairo svg cannot deal with multiple pages
-      pheight = len (splits) * (height + pgap) - pgap + 2 * p_y0
       surface = cairo.SVGSurface (filename,
                                   pwidth / 25.4 * 72,
                                   pheight / 25.4 * 72)
@@ -186,102 +946,172 @@ def output_file (model, filename, is_pdf, notelist, mindelta, papersize):
    cr.fill ()
    cr.restore ()
 
-   y0 = max (p_y0, pgap)
-   y1 = y0 + height
-
-   x0 = splits.pop (0)
-   while splits:
-      x1 = splits.pop (0)
+   for strip in plan["strips"]:
+      y0, y1 = strip["y0"], strip["y1"]
       cr.set_source_rgb (0, 0, 1)
       cr.set_line_width (0.4)
       # cr.rectangle (pborder, y0, x1 - x0, y1 - y0)
-      cr.move_to (p_x0, y0)
-      cr.line_to (p_x0, y1)
-      cr.move_to (p_x0 + x1 - x0, y0)
-      cr.line_to (p_x0 + x1 - x0, y1)
+      cr.move_to (strip["x0"], y0)
+      cr.line_to (strip["x0"], y1)
+      cr.move_to (strip["x1"], y0)
+      cr.line_to (strip["x1"], y1)
       cr.stroke ()
 
-      if 0:
-         cr.set_source_rgb (0.7, 0.7, 0.7)
-         for i in range (len (model["notes"])):
-            y = y0 + offset + i * dist
-            cr.move_to (pborder, y)
-            cr.line_to (pborder + x1 - x0, y)
-            if model["notes"][i] % 12 in [0, 2, 4, 5, 7, 9, 11]:
-               if model["notes"][i] % 12 == 0:
-                  cr.set_line_width (0.4)
-               else:
-                  cr.set_line_width (0.2)
-               cr.set_dash ([], 0)
-            else:
-               cr.set_line_width (0.2)
-               cr.set_dash ([.5, 1], 0)
-            cr.stroke ()
-
       cr.set_dash ([], 0)
       cr.set_line_width (0.4)
-      border_end = p_x0;
-      order = []
-      while holes and holes[0][0] < x1:
-         x, y = holes.pop (0)
-         order.append ((x, y))
-         cr.new_sub_path ()
-       # cr.arc (x - x0 + pborder, y + y0, radius, 0.0*math.pi, 0.5*math.pi)
-       # cr.arc (x - x0 + pborder, y + y0, radius, 0.5*math.pi, 1.0*math.pi)
-       # cr.arc (x - x0 + pborder, y + y0, radius, 1.0*math.pi, 1.5*math.pi)
-       # cr.arc (x - x0 + pborder, y + y0, radius, 1.5*math.pi, 2.0*math.pi)
-       ##cr.arc (x - x0 + pborder, y + y0, radius, 1.0*math.pi, 1.5*math.pi)
-       ##cr.line_to (x - x0 + pborder + radius, y + y0 - radius)
-       ##cr.line_to (x - x0 + pborder + radius, y + y0 + radius)
-       ##cr.line_to (x - x0 + pborder, y + y0 + radius)
-       ##cr.arc (x - x0 + pborder, y + y0, radius, 0.5*math.pi, 1.0*math.pi)
-       ##cr.close_path ()
-         cr.move_to (x - x0 + p_x0 - radius, y + y0)
-         cr.line_to (x - x0 + p_x0 + radius, y + y0)
-         cr.move_to (x - x0 + p_x0, y + y0 - radius)
-         cr.line_to (x - x0 + p_x0, y + y0 + radius)
-
-         if x - x0 + p_x0 - border_end >= 50:
-            cr.move_to (border_end, y0)
-            cr.line_to (x - x0 + p_x0, y0)
-            cr.move_to (border_end, y1)
-            cr.line_to (x - x0 + p_x0, y1)
+      for kind, a, b in strip["cuts"]:
+         if kind == "hole":
+            cr.new_sub_path ()
+          # cr.arc (x, y, radius, 0.0*math.pi, 0.5*math.pi)
+          # cr.arc (x, y, radius, 0.5*math.pi, 1.0*math.pi)
+          # cr.arc (x, y, radius, 1.0*math.pi, 1.5*math.pi)
+          # cr.arc (x, y, radius, 1.5*math.pi, 2.0*math.pi)
+          ##cr.arc (x, y, radius, 1.0*math.pi, 1.5*math.pi)
+          ##cr.line_to (x + radius, y - radius)
+          ##cr.line_to (x + radius, y + radius)
+          ##cr.line_to (x, y + radius)
+          ##cr.arc (x, y, radius, 0.5*math.pi, 1.0*math.pi)
+          ##cr.close_path ()
+            cr.move_to (a - radius, b)
+            cr.line_to (a + radius, b)
+            cr.move_to (a, b - radius)
+            cr.line_to (a, b + radius)
+         else:
+            cr.move_to (a, y0)
+            cr.line_to (b, y0)
+            cr.move_to (a, y1)
+            cr.line_to (b, y1)
             cr.new_sub_path ()
-            border_end = x - x0 + p_x0
-
-      if 0 and order:
-         order = sort_coords (order)
-         x, y = order.pop (0)
-         cr.move_to (x - x0 + pborder, y + y0)
-         while order:
-            x, y = order.pop (0)
-            cr.line_to (x - x0 + pborder, y + y0)
-
-      if border_end < x1:
-         cr.move_to (border_end, y0)
-         cr.line_to (x1 - x0 + p_x0, y0)
-         cr.move_to (border_end, y1)
-         cr.line_to (x1 - x0 + p_x0, y1)
-         cr.new_sub_path ()
 
       cr.set_source_rgb (0, 0, 0)
       cr.stroke ()
 
-      x0 = x1
-      y0 = y1 + pgap
-      if y0 + height + p_y0 > pheight:
-         y0 = p_y0
+      if "label" in strip:
+         # packed strips are numbered for glueing them together
+         cr.save ()
+         cr.set_source_rgb (1, 0, 0)
+         cr.set_font_size (3)
+         cr.move_to (strip["x0"] + 1, y1 - 4.5)
+         cr.scale (1, -1)
+         cr.show_text (str (strip["label"]))
+         cr.restore ()
+
+      if strip["page_break"]:
          cr.show_page ()
-      y1 = y0 + height
 
    del cr
    del surface
 
 
+def svg_number (value):
+   return ("%.3f" % value).rstrip ("0").rstrip (".")
+
+
+def write_svg (plan, filename):
+   # streams the svg without cairo: every hole is a <use> of one
+   # symbol, the cuts come before the strip outlines.
+   pwidth  = plan["width"]
+   pheight = plan["height"]
+   p_x0    = plan["x0"]
+   p_y0    = plan["y0"]
+   r       = svg_number (plan["radius"])
+   n       = svg_number
+
+   with open (filename, "w") as f:
+      f.write ('<?xml version="1.0" encoding="UTF-8"?>\n')
+      f.write ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+               'width="%spt" height="%spt" viewBox="0 0 %s %s" version="1.1">\n' %
+               (n (pwidth / 25.4 * 72), n (pheight / 25.4 * 72),
+                n (pwidth / 25.4 * 72), n (pheight / 25.4 * 72)))
+      f.write ('<defs><symbol id="hole" overflow="visible">'
+               '<path d="M-%s 0H%sM0 -%sV%s"/></symbol></defs>\n' % (r, r, r, r))
+      f.write ('<g transform="matrix(2.83464 0 0 -2.83464 0 %s)" fill="none" stroke-width="0.4">\n' %
+               n (pheight * 2.83464))
+
+      # holes and border sections in cut order, a strip is only freed
+      # by its blue ends after all of its holes are cut
+      f.write ('<g id="cuts" stroke="#000">\n')
+      for strip in plan["strips"]:
+         y0, y1 = n (strip["y0"]), n (strip["y1"])
+         for kind, a, b in strip["cuts"]:
+            if kind == "hole":
+               f.write ('<use xlink:href="#hole" x="%s" y="%s"/>\n' % (n (a), n (b)))
+            else:
+               f.write ('<path d="M%s %sH%sM%s %sH%s"/>\n' % (n (a), y0, n (b), n (a), y1, n (b)))
+      f.write ('</g>\n')
+
+      f.write ('<g id="outline">\n')
+      f.write ('<path fill="#000" stroke="none" transform="translate(%s %s)" '
+               'd="M4 5L7 7L7 5.7L17 5.7L17 4.3L7 4.3L7 3Z"/>\n' % (n (p_x0), n (p_y0)))
+      for strip in plan["strips"]:
+         y0, y1 = n (strip["y0"]), n (strip["y1"])
+         f.write ('<path stroke="#00f" d="M%s %sV%sM%s %sV%s"/>\n' %
+                  (n (strip["x0"]), y0, y1, n (strip["x1"]), y0, y1))
+         if "label" in strip:
+            f.write ('<text fill="#f00" stroke="none" font-size="3" '
+                     'transform="translate(%s %s) scale(1 -1)">%d</text>\n' %
+                     (n (strip["x0"] + 1), n (strip["y1"] - 4.5), strip["label"]))
+      f.write ('</g>\n')
+
+      f.write ('</g>\n</svg>\n')
+
+
+def draw_plan (plan, filename, is_pdf, native_svg=False):
+   if native_svg and not is_pdf:
+      write_svg (plan, filename)
+   else:
+      draw_cairo (plan, filename, is_pdf)
+
+
+def output_file (layout, filename, is_pdf, papersize, optimize=0,
+                 native_svg=False, stats=None, jobs=1, svg_pages=False,
+                 pack=0):
+   # with more than one job the strips are planned and the svg pages
+   # are written in worker processes, the output does not change.
+   import concurrent.futures
+
+   separate = svg_pages and not is_pdf
+   with (concurrent.futures.ProcessPoolExecutor (jobs) if jobs > 1
+         else contextlib.nullcontext ()) as pool:
+      plan = layout.plan (papersize, optimize, not is_pdf and not separate,
+                          stats, pool, pack)
+
+      if separate:
+         pages = split_pages (plan)
+         names = [page_filename (filename, i + 1) for i in range (len (pages))]
+         list ((pool.map if pool else map) (draw_plan, pages, names,
+                                            [False] * len (pages),
+                                            [native_svg] * len (pages)))
+      else:
+         draw_plan (plan, filename, is_pdf, native_svg)
+
+   print ("laser travel: %.1f mm in time order, %.1f mm optimized" % tuple (plan["travel"]), file=sys.stderr)
+   used = sum ([(s["x1"] - s["x0"]) * (s["y1"] - s["y0"]) for s in plan["strips"]])
+   used = 100 * used / (plan["pages"] * plan["width"] * plan["height"])
+   print ("paper: %d strips on %d pages, %.1f%% used" % (len (plan["strips"]), plan["pages"], used), file=sys.stderr)
+   if stats:
+      stats.count ("pages", plan["pages"])
+      stats.count ("strips", len (plan["strips"]))
+      stats.count ("travel time order/mm", round (plan["travel"][0], 1))
+      stats.count ("travel optimized/mm", round (plan["travel"][1], 1))
+
 
-def output_midi (model, filename, notelist, mindelta):
+
+def vlq (value):
+   # midi variable-length quantity: 7 bits per byte, most significant
+   # first, the high bit marks continuation bytes
+   data = bytearray ((value & 0x7f,))
+   value >>= 7
+   while value:
+      data.append (0x80 | (value & 0x7f))
+      value >>= 7
+   data.reverse ()
+   return data
+
+
+def output_midi (model, filename, notelist, mindelta, timediv, tempo=500000):
    # fix up notes to correspond to midi notes
-   notes = [ n + model["lowest"] for n in model["notes"] ]
+   notes = model["pitches"]
 
    events = []
    for i in range (len (notelist)):
@@ -292,33 +1122,104 @@ def output_midi (model, filename, notelist, mindelta):
    events.sort()
 
    last_time = 0
-   eventdata = b''
-   # program select
+   eventdata = bytearray ()
+   # tempo of the roll and program select
+   eventdata += b"\x00\xFF\x51\x03" + struct.pack (">i", tempo)[1:]
    eventdata += bytes ([0x00, 0xc0, model["program"]])
 
    for t, i, on in events:
-      dt = t - last_time
-      if (dt >> 21):
-         eventdata += bytes ([0x80 | ((dt >> 21) & 0x7f)])
-      if (dt >> 14):
-         eventdata += bytes ([0x80 | ((dt >> 14) & 0x7f)])
-      if (dt >> 7):
-         eventdata += bytes ([0x80 | ((dt >>  7) & 0x7f)])
-
-      eventdata += bytes ([0x00 | ((dt >> 0) & 0x7f)])
-      if on:
-         eventdata += bytes ([0x90, i, 127])
-      else:
-         eventdata += bytes ([0x80, i, 127])
-      last_time += dt
+      eventdata += vlq (t - last_time)
+      eventdata += bytes ([0x90 if on else 0x80, i, 127])
+      last_time = t
 
    eventdata += b"\x00\xFF\x2F\x00"
 
-   outfile = open (filename, "wb")
-   outfile.write (b'MThd' + struct.pack (">ihhh", 6, 0, 1, delta_ticks))
-   outfile.write (b'MTrk' + struct.pack (">i", len (eventdata)))
-   outfile.write (eventdata)
-   outfile.close ()
+   with open (filename, "wb") as outfile:
+      outfile.write (b'MThd' + struct.pack (">ihhh", 6, 0, 1, timediv) +
+                     b'MTrk' + struct.pack (">i", len (eventdata)) +
+                     eventdata)
+
+
+
+def output_wav (model, filename, notelist, mindelta, rpm=120.0, rate=22050):
+   # a preview of the strip played on the box: the strip moves "speed"
+   # mm per turn of the crank, every tooth rings with the decaying
+   # partials of a clamped bar and the strikes are added into one buffer
+   import numpy
+   import wave
+
+   seconds = model["step"] / mindelta / model["speed"] * 60.0 / rpm
+   start = min ([b[0] for b in notelist if b] or [0])
+   ring = int (rate * 1.5)
+   t = numpy.arange (ring) / rate
+   strikes = [numpy.round ((numpy.array (b, dtype=float) - start) * seconds * rate).astype (numpy.int64)
+              for b in notelist]
+   out = numpy.zeros (max ([int (s[-1]) for s in strikes if len (s)] or [0]) + ring,
+                      numpy.float32)
+   # row n is the buffer from sample n on
+   rows = numpy.lib.stride_tricks.as_strided (out, (len (out) - ring + 1, ring),
+                                               (out.itemsize, out.itemsize))
+
+   for i, s in enumerate (strikes):
+      if not len (s):
+         continue
+      f = 440.0 * 2 ** ((model["pitches"][i] - 69) / 12.0)
+      damping = (f / 261.6) ** 0.5
+      tone = numpy.zeros (ring, numpy.float32)
+      for ratio, amp, decay in ((1.0, 1.0, 2.5), (6.27, 0.3, 10.0), (17.55, 0.1, 25.0)):
+         if f * ratio < rate / 2:
+            tone += amp * numpy.exp (-decay * damping * t) * numpy.sin (2 * numpy.pi * f * ratio * t)
+
+      # every k-th strike of a tooth is a ring apart, so the rows
+      # don't overlap and are added at once
+      gap = int (numpy.diff (s).min ()) if len (s) > 1 else ring
+      k = min (-(-ring // max (gap, 1)), len (s))
+      for j in range (k):
+         rows[s[j::k]] += tone
+
+   peak = numpy.abs (out).max ()
+   if peak > 0:
+      out *= 0.9 * 32767 / peak
+
+   with wave.open (filename, "wb") as outfile:
+      outfile.setnchannels (1)
+      outfile.setsampwidth (2)
+      outfile.setframerate (rate)
+      outfile.writeframes (out.astype ("<i2").tobytes ())
+
+
+def transpose_errors (notecount, available_notes,
+                      allow_octaves=True, allow_halftones=True):
+   # correlate the pitch histogram with the set of playable pitches,
+   # returns {transpose: number of unplayable notes} for all candidates
+   pitches = [i for i in range (128) if notecount[i]]
+   if not pitches:
+      return {}
+   total = sum (notecount)
+   available = set (available_notes)
+
+   errors = {}
+   for trans in range (min (available_notes) - pitches[-1] - 1,
+                       max (available_notes) - pitches[0] + 2):
+      if not allow_halftones and trans % 12 != 0:
+         continue
+
+      if not allow_halftones and not allow_octaves and trans % 12 == 0:
+         continue
+
+      errors[trans] = total - sum ([notecount[a - trans] for a in available
+                                    if 0 <= a - trans < 128])
+   return errors
+
+
+# int.bit_count is python 3.10
+popcount = getattr (int, "bit_count", lambda x: bin (x).count ("1"))
+
+
+def best_transpose (errors):
+   # candidates are in ascending order, min() keeps the first one
+   transpose = min (errors, key=lambda t: (errors[t], abs (t)))
+   return transpose, errors[transpose]
 
 
 
@@ -335,65 +1236,213 @@ class Note (object):
       return "Note (%s, %d, %d, %d)" % (self.note, self.ticks, self.channel, self.track)
 
 
+class TempoMap (object):
+   # the tempo changes of a tune as segments (first tick, uS per quarter)
+   # with the time before each segment summed up. Times are kept in
+   # uS * timediv, so they stay integers. A tick is looked up by
+   # bisection, increasing runs of ticks are converted in a single pass.
+   def __init__ (self, changes=[]):
+      self.starts = [0]
+      self.tempos = [500000]
+      self.prefix = [0]
+      for ticks, tempo in sorted (changes, key=lambda c: c[0]):
+         self.add (ticks, tempo)
+
+
+   def __len__ (self):
+      return len (self.starts)
+
+
+   def add (self, ticks, tempo):
+      # changes have to come in time order
+      if ticks < self.starts[-1]:
+         raise Exception ("tempo change at %d before %d" % (ticks, self.starts[-1]))
+      if ticks == self.starts[-1]:
+         self.tempos[-1] = tempo
+         return
+      self.prefix.append (self.time (ticks))
+      self.starts.append (ticks)
+      self.tempos.append (tempo)
+
+
+   def time (self, ticks):
+      k = bisect.bisect_right (self.starts, ticks) - 1
+      return self.prefix[k] + (ticks - self.starts[k]) * self.tempos[k]
+
+
+   def ticks (self, ticks):
+      # the ticks at the initial tempo taking the same time
+      t0 = self.tempos[0]
+      return (self.time (ticks) + t0 // 2) // t0
+
+
+   def convert (self, ticks):
+      # ticks () for a whole sequence
+      if len (self.starts) == 1:
+         return ticks
+      starts, tempos, prefix = self.starts, self.tempos, self.prefix
+      t0 = self.tempos[0]
+      k, begin, end = 0, 0, 0
+      result = []
+      for t in ticks:
+         if not begin <= t < end:
+            k = bisect.bisect_right (starts, t) - 1
+            begin = starts[k]
+            end = starts[k+1] if k + 1 < len (starts) else sys.maxsize
+         result.append ((prefix[k] + (t - begin) * tempos[k] + t0 // 2) // t0)
+      return result
+
+
 class PianoRoll (object):
+   # the notes are kept in parallel typed arrays (one entry per noteon)
+   # with a bitmask of filter reasons per note. The ticks follow the
+   # playback time at the initial tempo (see set_tempo).
+   filter_bits = { "delta": 1 }
+
    def __init__ (self, notes=[]):
-      self.notes = notes
+      self.pitch    = array ('B')
+      self.ticks    = array ('q')
+      self.channel  = array ('B')
+      self.track    = array ('H')
+      self.filtered = bytearray ()
       self.transpose = [0]
+      self.timediv = 480
+      self.tempo = 500000
+      self.invalidate ()
+      for n in notes:
+         self.add (n)
 
 
    def __repr__ (self):
       return "PianoRoll (%r)" % (self.notes)
 
 
-   def add (self, note):
-      self.notes.append (note)
+   def __len__ (self):
+      return len (self.pitch)
 
 
-   def get_compat_band (self, model):
-      self.notes.sort (key=lambda x: x.ticks)
+   def invalidate (self):
+      self._by_pitch = None
+      self._histogram = None
 
-      notes = [n + model["lowest"] for n in model["notes"]]
-      band = [[] for i in range (len(notes))]
-      for i in range (len (notes)):
-         source_notes = [notes[i]]
-         n = notes[i] - 12
-         while n >= 0 and n not in notes:
-            source_notes.append (n)
-            n -= 12
-         n = notes[i] + 12
-         while n <= 127 and  n not in notes:
-            source_notes.append (n)
-            n += 12
 
-         band[i] = [n.ticks for n in self.notes
-                        if n.note + self.transpose[n.track % len (self.transpose)] in source_notes
-                        if not n.filtered]
-         band[i] = sorted (list (set (band[i])))
+   def add_note (self, note, ticks, channel, track):
+      self.pitch.append (note)
+      self.ticks.append (ticks)
+      self.channel.append (channel)
+      self.track.append (track)
+      self.filtered.append (0)
+      self.invalidate ()
 
-      return band
 
+   def as_data (self):
+      # the notes as plain data, e.g. for the cache
+      return { "pitch"    : self.pitch,
+               "ticks"    : self.ticks,
+               "channel"  : self.channel,
+               "track"    : self.track,
+               "filtered" : bytes (self.filtered),
+               "timediv"  : self.timediv,
+               "tempo"    : self.tempo }
 
-   def min_repetition (self):
-      self.notes.sort (key=lambda x: x.ticks)
-      self.notes.sort (key=lambda x: x.note)
+
+   def set_data (self, data):
+      self.pitch    = array ('B', data["pitch"])
+      self.ticks    = array ('q', data["ticks"])
+      self.channel  = array ('B', data["channel"])
+      self.track    = array ('H', data["track"])
+      self.filtered = bytearray (data["filtered"])
+      self.timediv  = data["timediv"]
+      self.tempo    = data["tempo"]
+      self.invalidate ()
+
+
+   def set_tempo (self, tempo_map):
+      # moves the notes to the ticks at the initial tempo, so that the
+      # distances of the holes follow the playback time
+      self.ticks = array ('q', tempo_map.convert (self.ticks))
+      self.tempo = tempo_map.tempos[0]
+      self.invalidate ()
+
+
+   def add (self, note):
+      self.add_note (note.note, note.ticks, note.channel, note.track)
+      for f in note.filtered:
+         self.filtered[-1] |= self.filter_bits[f]
+
+
+   @property
+   def notes (self):
+      # snapshot of the roll as Note objects, for inspection only
+      notes = []
+      for i in range (len (self.pitch)):
+         n = Note (self.pitch[i], self.ticks[i], self.channel[i], self.track[i])
+         n.filtered = set ([f for f, bit in self.filter_bits.items ()
+                            if self.filtered[i] & bit])
+         notes.append (n)
+      return notes
+
+
+   def by_pitch (self):
+      # note indices sorted by (pitch, ticks), built once per roll
+      if self._by_pitch is None:
+         keys = [(p << 48) | t for p, t in zip (self.pitch, self.ticks)]
+         self._by_pitch = array ('l', sorted (range (len (keys)),
+                                              key=keys.__getitem__))
+      return self._by_pitch
+
+
+   def get_compat_band (self, model, stats=None):
+      # stats (a dict) optionally receives the number of notes without
+      # any tooth even after octave folding ("no_tooth") and of octave
+      # folded notes ("folded")
+      table = model["folds"]
+      playable = model["playable"]
+      band = [set () for i in model["notes"]]
+      transpose = self.transpose
+      unplayable = folded = 0
+      for note, ticks, track, filtered in zip (self.pitch, self.ticks,
+                                               self.track, self.filtered):
+         if filtered:
+            continue
+         note += transpose[track % len (transpose)]
+         teeth = table[note] if 0 <= note <= 127 else ()
+         for i in teeth:
+            band[i].add (ticks)
+         if not teeth:
+            unplayable += 1
+         elif not playable[note]:
+            folded += 1
+
+      if stats is not None:
+         stats["no_tooth"] = unplayable
+         stats["folded"] = folded
+
+      return [sorted (b) for b in band]
+
+
+   def min_repetition (self, verbose=False):
+      pitch, ticks, filtered = self.pitch, self.ticks, self.filtered
       mindelta = sys.maxsize
       distances = {}
-      n0 = self.notes[0]
-      for n1 in self.notes[1:]:
-         if n1.note == n0.note:
-            if n1.filtered:
+      order = iter (self.by_pitch ())
+      n0 = next (order, None)
+      for n1 in order:
+         if pitch[n1] == pitch[n0]:
+            if filtered[n1]:
                continue
-            d = n1.ticks - n0.ticks
+            d = ticks[n1] - ticks[n0]
             # notes at the same tick are considered identical
             if d > 0:
                distances[d] = distances.get (d, 0) + 1;
                mindelta = min (mindelta, d)
          n0 = n1
 
-      dists = list (distances.keys ())
-      dists.sort ()
-      for i in dists[:10]:
-         print (i, distances[i])
+      if verbose:
+         dists = list (distances.keys ())
+         dists.sort ()
+         for i in dists[:10]:
+            print (i, distances[i], file=sys.stderr)
 
       if mindelta == sys.maxsize:
          mindelta = 480
@@ -401,71 +1450,294 @@ class PianoRoll (object):
       return mindelta
 
 
+   def pitch_histogram (self):
+      if self._histogram is None:
+         notecount = [0] * 128
+         for note in self.pitch:
+            notecount[note] += 1
+         self._histogram = notecount
+      return self._histogram
+
+
+   def transpose_errors (self, available_notes,
+                         allow_octaves=True, allow_halftones=True):
+      return transpose_errors (self.pitch_histogram (), available_notes,
+                               allow_octaves, allow_halftones)
+
+
    def find_transpose (self, available_notes,
-                       allow_octaves=True, allow_halftones=True):
+                       allow_octaves=True, allow_halftones=True, verbose=True):
       transpose = 0
       transpose_error = sys.maxsize
 
-      highest = max ([n.note for n in self.notes])
-      lowest  = min ([n.note for n in self.notes])
+      errors = self.transpose_errors (available_notes,
+                                      allow_octaves, allow_halftones)
+      if errors:
+         transpose, transpose_error = best_transpose (errors)
 
-      notecount = [len ([n for n in self.notes if n.note == i])
-                   for i in range (128)]
+      if verbose:
+         print ("transposing by %d octaves and %d halftones" % (transpose / 12, transpose % 12), file=sys.stderr)
+         print ("    --> %d notes not playable" % (transpose_error), file=sys.stderr)
 
-      for trans in range (min (available_notes) - highest - 1,
-                          max (available_notes) - lowest + 2):
-         if not allow_halftones and trans % 12 != 0:
-            continue
+      return transpose
 
-         if not allow_halftones and not allow_octaves and trans % 12 == 0:
-            continue
 
-         errcount = 0
-         for i in range (128):
-            if (i+trans) not in available_notes:
-               errcount += notecount[i]
-         if errcount < transpose_error or (errcount == transpose_error and abs(trans) < abs (transpose)):
-            transpose_error = errcount
-            transpose = trans
+   def find_track_transpose (self, model, octave_tracks=[], max_sweeps=8):
+      # coordinate descent over the per-track transpose values, starting
+      # from the global optimum. The cost of a track is its number of
+      # unplayable notes plus the notes landing on a tooth which already
+      # gets struck at the same time. Candidates are tried in order of
+      # their unplayable notes, which is a lower bound for the cost.
+      # Every tick with a note is a bit, the ticks a pitch of a track is
+      # struck at are an int, so the collisions of a candidate are
+      # counted per tooth and not per note.
+      available = model["pitches"]
+      avail = set (available)
+      table = model["folds"]
+      start = self.find_transpose (available)
+
+      n_tracks = max (self.track) + 1
+      hist = [[0] * 128 for t in range (n_tracks)]
+      notes = [[] for t in range (n_tracks)]
+      slots = dict ([(ticks, i) for i, ticks in enumerate (sorted (set (self.ticks)))])
+      struck = [{} for t in range (n_tracks)]
+      for note, ticks, track, filtered in zip (self.pitch, self.ticks,
+                                               self.track, self.filtered):
+         if not filtered:
+            hist[track][note] += 1
+            notes[track].append ((note, ticks))
+            struck[track].setdefault (note, set ()).add (slots[ticks])
+      for s in struck:
+         for note in s:
+            s[note] = sum ([1 << i for i in s[note]])
+
+      candidates = []
+      for t in range (n_tracks):
+         if not notes[t]:
+            candidates.append ([(0, start)])
+            continue
+         pitches = [i for i in range (128) if hist[t][i]]
+         shifts = range (min (available) - pitches[-1] - 1,
+                         max (available) - pitches[0] + 2)
+         if t in octave_tracks:
+            shifts = [s for s in shifts if (s - start) % 12 == 0] or [start]
+         total = len (notes[t])
+         candidates.append (sorted ([(total - sum ([hist[t][a - s] for a in avail
+                                                    if 0 <= a - s < 128]), s)
+                                     for s in shifts]))
+
+      def strikes (t, shift):
+         # {tooth: (ticks, number of strikes)} of a track, folded notes
+         # share a tooth
+         teeth = {}
+         for note, bits in struck[t].items ():
+            if 0 <= note + shift <= 127:
+               for i in table[note + shift]:
+                  b, n = teeth.get (i, (0, 0))
+                  teeth[i] = (b | bits, n + hist[t][note])
+         return teeth
+
+      transpose = [start] * n_tracks
+      placed = [strikes (t, start) for t in range (n_tracks)]
+
+      for sweep in range (max_sweeps):
+         changed = False
+         for t in range (n_tracks):
+            if len (candidates[t]) < 2:
+               continue
+            # the ticks each tooth is struck at by the other tracks
+            occupied = {}
+            for u in range (n_tracks):
+               if u != t:
+                  for i, (bits, n) in placed[u].items ():
+                     occupied[i] = occupied.get (i, 0) | bits
+
+            best = None
+            for unplayable, shift in candidates[t]:
+               if best and unplayable > best[0]:
+                  break
+               # repeated strikes of the track itself, and its strikes
+               # at the time of another track
+               cost = unplayable
+               for i, (bits, n) in strikes (t, shift).items ():
+                  cost += n - popcount (bits) + popcount (bits & occupied.get (i, 0))
+               rank = (cost, shift != transpose[t], abs (shift - start), shift)
+               if best is None or rank < best:
+                  best = rank
+
+            if best[3] != transpose[t]:
+               transpose[t] = best[3]
+               placed[t] = strikes (t, transpose[t])
+               changed = True
+
+         if not changed:
+            break
 
-      print ("transposing by %d octaves and %d halftones" % (transpose / 12, transpose % 12), file=sys.stderr)
-      print ("    --> %d notes not playable" % (transpose_error), file=sys.stderr)
+      unplayable = sum ([1 for t in range (n_tracks) for note, ticks in notes[t]
+                         if note + transpose[t] not in avail])
+      teeth = {}
+      for t in range (n_tracks):
+         for i, (bits, n) in placed[t].items ():
+            b, m = teeth.get (i, (0, 0))
+            teeth[i] = (b | bits, m + n)
+      collisions = sum ([n - popcount (bits) for bits, n in teeth.values ()])
+      for t in range (n_tracks):
+         if notes[t]:
+            print ("track %d: transposing by %d halftones" % (t, transpose[t]), file=sys.stderr)
+      print ("    --> %d notes not playable, %d tooth collisions" % (unplayable, collisions), file=sys.stderr)
 
       return transpose
 
 
+   def count_unplayable (self, available_notes):
+      available = set (available_notes)
+      transpose = self.transpose
+      return len ([1 for note, track in zip (self.pitch, self.track)
+                   if note + transpose[track % len (transpose)] not in available])
+
+
    def filter_repetition (self, delta):
-      self.notes.sort (key=lambda x: x.ticks)
-      self.notes.sort (key=lambda x: x.note)
+      pitch, ticks, filtered = self.pitch, self.ticks, self.filtered
+      bit = self.filter_bits["delta"]
       count = 0
-      n0 = self.notes[0]
-      for n1 in self.notes[1:]:
-         if n1.note == n0.note:
-            d = n1.ticks - n0.ticks
+      order = iter (self.by_pitch ())
+      n0 = next (order, None)
+      for n1 in order:
+         if pitch[n1] == pitch[n0]:
+            d = ticks[n1] - ticks[n0]
             if d < delta:
-               n1.filtered.add ("delta")
+               filtered[n1] |= bit
                count += 1
             else:
-               n1.filtered.discard ("delta")
+               filtered[n1] &= ~bit & 0xff
                n0 = n1
          else:
             n0 = n1
-            n0.filtered.discard ("delta")
+            filtered[n0] &= ~bit & 0xff
 
       return count
 
 
 
+def iter_track_events (eventdata, track=0):
+   # yields (ticks, track, event) for all events of a MTrk chunk.
+   # walk the track with an offset cursor, slicing the buffer would
+   # copy the remaining track for every event.
+   t = memoryview (eventdata)
+   end = len (t)
+   pos = 0
+   ticks = 0
+   mc = None
+   while pos < end:
+      dt = 0
+      while t[pos] & 0x80:
+         dt = (dt + (t[pos] & 0x7f)) << 7
+         pos += 1
+      dt += t[pos]
+      pos += 1
+
+      if t[pos] & 0x80:
+         mc = t[pos]
+         pos += 1
+
+      if mc >> 4 in (0x08, 0x09, 0x0a, 0x0b, 0x0e):
+         command = bytes ((mc, t[pos], t[pos+1]))
+         pos += 2
+      elif mc >> 4 in (0x0c, 0x0d):
+         command = bytes ((mc, t[pos]))
+         pos += 1
+      elif mc in (0xf8, 0xfa, 0xfb, 0xfc):
+         command = bytes ((mc,))
+      elif mc == 0xff or mc in (0xf0, 0xf7):
+         # meta event (type byte + length) or sysex (length)
+         start = pos
+         if mc == 0xff:
+            pos += 1
+         l = 0
+         while t[pos] & 0x80:
+            l = (l + (t[pos] & 0x7f)) << 7
+            pos += 1
+         l += t[pos]
+         pos += l + 1
+         command = bytes ((mc,)) + t[start:pos]
+      else:
+         raise Exception ('unknown MIDI event: %d' % t[pos])
+
+      ticks += dt
+      yield ticks, track, command
+
+
+def iter_chunks (data):
+   # yields (chunkname, chunkdata) for the chunks of a MIDI file, the
+   # chunk data is a view into data.
+   t = memoryview (data)
+   pos = 0
+   while pos < len (t):
+      if len (t) - pos < 8:
+         print ("%d bytes remaining at end of MIDI file" % (len (t) - pos), file=sys.stderr)
+         break
+      chunkname = t[pos:pos+4].tobytes ()
+      chunklen = struct.unpack_from (">I", t, pos+4)[0]
+      if len (t) - pos < 8+chunklen:
+         raise Exception ("Not enough bytes in MIDI file")
+      yield chunkname, t[pos+8:pos+8+chunklen]
+      pos += 8+chunklen
+
+
+def iter_events (filename, ignoretracks=[]):
+   # yields (ticks, track, event) for all tracks merged in time order,
+   # events at the same tick come in file order. The file is memory
+   # mapped and every track is decoded lazily, of ignored tracks only
+   # the tempo changes are passed on.
+   with open (filename, "rb") as f:
+      if os.fstat (f.fileno ()).st_size == 0:
+         raise Exception ("first chunk is not MThd")
+      m = mmap.mmap (f.fileno (), 0, access=mmap.ACCESS_READ)
+
+   tracks = []
+   header = False
+   try:
+      n_tracks = 0
+      for chunkname, chunkdata in iter_chunks (m):
+         if chunkname == b'MThd':
+            header = True
+         elif not header:
+            raise Exception ("first chunk is not MThd")
+         elif chunkname == b'MTrk':
+            if n_tracks not in ignoretracks:
+               tracks.append (iter_track_events (chunkdata, n_tracks))
+            else:
+               tracks.append (e for e in iter_track_events (chunkdata, n_tracks)
+                              if e[2][:2] == b"\xff\x51")
+            n_tracks += 1
+      chunkdata = None
+      yield from heapq.merge (*tracks, key=lambda e: e[0])
+   finally:
+      # the map can only be closed when no view into it is left,
+      # otherwise it gets closed by the garbage collector.
+      for t in tracks:
+         t.close ()
+      del tracks[:]
+      try:
+         m.close ()
+      except BufferError:
+         pass
+
+
+
 class MidiImporter (object):
-   def __init__ (self, target):
+   def __init__ (self, target, stats=None):
       self.target = target
+      self.stats = stats or Stats ()
       self.timediv = 0
       self.num_tracks = 0
       self.cur_program = -1
+      self.tempo_changes = []
 
 
    def import_event (self, ticks, track, eventdata):
       cur_program = -1;
+      count = self.stats.count
       mc = eventdata[0] >> 4
       ch = eventdata[0] & 0x0f
 
@@ -474,99 +1746,57 @@ class MidiImporter (object):
          mc = 0x08
 
       if mc == 0x08:
-         pass
-         # print >>sys.stderr, ticks, ": noteoff"
+         count ("noteoff")
       elif mc == 0x09:
-         # print >>sys.stderr, ticks, ": noteon (%d)" % (eventdata[0] & 0x0f), eventdata[1], eventdata[2]
+         count ("noteon")
          if self.cur_program != 127: # exclude percussion track
-            n = Note (eventdata[1], ticks, ch, track)
-            self.target.add (n)
+            self.target.add_note (eventdata[1], ticks, ch, track)
       elif mc == 0x0b:
-         # print >>sys.stderr, ticks, ": controller", eventdata[1]
-         pass
+         count ("controller")
       elif mc == 0x0c:
-         print (ticks, ": program change", eventdata[1], file=sys.stderr)
+         count ("program change")
+         self.stats.log (ticks, ": program change", eventdata[1])
          self.cur_program = eventdata[1]
-         pass
       elif mc == 0x0d:
-         # print >>sys.stderr, ticks, ": aftertouch", eventdata[1]
-         pass
+         count ("aftertouch")
       elif mc == 0x0e:
-         # print >>sys.stderr, ticks, ": pitch bend"
-         pass
+         count ("pitch bend")
       elif eventdata[:2] == b"\xff\x51" and len (eventdata) == 6:
+         count ("tempo")
          uSq = (eventdata[3] << 16) + (eventdata[4] << 8) + eventdata[5]
          bpm = 60 * 1000000 / uSq
-         print ("Tempo: %.2f (%d uS/q)" % (bpm, uSq))
+         self.stats.log ("Tempo: %.2f (%d uS/q)" % (bpm, uSq))
+         self.tempo_changes.append ((ticks, uSq))
       elif eventdata[:2] == b"\xff\x58" and len (eventdata) == 7:
-         print ("Time Signature: %d/%d" % (eventdata[3], 2**eventdata[4]))
+         count ("time signature")
+         self.stats.log ("Time Signature: %d/%d" % (eventdata[3], 2**eventdata[4]))
       else:
-         print ("ticks: %d, event %r" % (ticks, eventdata), file=sys.stderr)
-         pass
+         if eventdata[0] == 0xff:
+            count ("meta")
+         elif eventdata[0] in (0xf0, 0xf7):
+            count ("sysex")
+         else:
+            count ("other")
+         self.stats.log ("ticks: %d, event %r" % (ticks, eventdata))
 
 
    def import_ticked_events (self, track, eventdata):
-      ticks = 0
-      mc = None
-      t = eventdata
-      while t:
-         dt = 0
-         while t[0] & 0x80:
-            dt = (dt + (t[0] & 0x7f)) << 7
-            t = t[1:]
-         dt += t[0]
-
-         t = t[1:]
-
-         if t[0] & 0x80:
-            mc = t[0]
-            t = t[1:]
-
-         if mc >> 4 in [0x08, 0x09, 0x0a, 0x0b, 0x0e]:
-            command = bytes ([mc, t[0], t[1]])
-            t = t[2:]
-         elif mc >> 4 in [0x0c, 0x0d]:
-            command = bytes ([mc, t[0]])
-            t = t[1:]
-         elif mc in [0xf8, 0xfa, 0xfb, 0xfc]:
-            command = bytes ([mc])
-         elif mc == 0xff:
-            # meta event
-            type = t[0]
-            t = t[1:]
-            command = bytes ([mc, type])
-            l = 0
-            while t[0] & 0x80:
-               command += bytes ([t[0]])
-               l = (l + (t[0] & 0x7f)) << 7
-               t = t[1:]
-            l += t[0]
-            command += t[:l+1]
-            t = t[l+1:]
-         elif mc in [0xf0, 0xf7]:
-            command = bytes ([mc])
-            l = 0
-            while t[0] & 0x80:
-               command += bytes ([t[0]])
-               l = (l + (t[0] & 0x7f)) << 7
-               t = t[1:]
-            l += t[0]
-            command += t[:l+1]
-            t = t[l+1:]
-         else:
-            raise Exception ('unknown MIDI event: %d' % t[0])
-
-         ticks += dt
+      for ticks, track, command in iter_track_events (eventdata, track):
          self.import_event (ticks, track, command)
 
 
+   def import_tempo_events (self, track, eventdata):
+      # the notes of ignored tracks are dropped, not their tempo changes
+      for ticks, track, command in iter_track_events (eventdata, track):
+         if command[:2] == b"\xff\x51":
+            self.import_event (ticks, track, command)
+
+
    def import_chunk (self, chunkname, chunkdata, ignoretracks):
       if self.timediv == 0 and chunkname != b'MThd':
          raise Exception ("first chunk is not MThd")
 
       if chunkname == b'MThd':
-         global delta_ticks
-
          if self.timediv != 0:
             raise Exception ("multiple MThd chunks")
 
@@ -574,121 +1804,1040 @@ class MidiImporter (object):
             raise Exception ("invalid MThd chunk")
          mtype, n_tracks, delta_ticks = struct.unpack (">hhh", chunkdata)
          self.timediv = delta_ticks
+         self.target.timediv = delta_ticks
 
-         print ("type: %d, n_tracks: %d, delta_ticks: %d" % (mtype, n_tracks, delta_ticks), file=sys.stderr)
+         self.stats.log ("type: %d, n_tracks: %d, delta_ticks: %d" % (mtype, n_tracks, delta_ticks))
 
       elif chunkname == b'MTrk':
          if self.num_tracks not in ignoretracks:
             self.import_ticked_events (self.num_tracks, chunkdata)
+         else:
+            self.import_tempo_events (self.num_tracks, chunkdata)
          self.num_tracks += 1
 
 
+   def import_data (self, data, ignoretracks=[]):
+      for chunkname, chunkdata in iter_chunks (data):
+         self.stats.log (chunkname, len (chunkdata))
+         self.import_chunk (chunkname, chunkdata, ignoretracks)
+      if self.timediv == 0:
+         raise Exception ("no MThd chunk")
+      self.stats.log ("%d tracks" % self.num_tracks)
+      # the tempo changes may be in any track, the notes are moved once
+      # all of them are known
+      if self.tempo_changes:
+         self.target.set_tempo (TempoMap (self.tempo_changes))
+
+
    def import_file (self, filename, ignoretracks=[]):
-      t = open (filename, "rb").read()
+      with open (filename, "rb") as f:
+         self.import_data (f.read (), ignoretracks)
+
+
+
+class StreamAnalysis (object):
+   # analysis of an event stream in time order, e.g. from iter_events().
+   # Only per-pitch and per-track state is kept, the memory needed does
+   # not grow with the length of the tune.
+   def __init__ (self, delta=1, stats=None):
+      self.delta = delta
+      self.stats = stats or Stats ()
+      self.histograms = {}
+      self.last = [None] * 128
+      self.program = {}
+      self.mindelta = sys.maxsize
+      self.notes = 0
+      self.filtered = 0
+      self.tempo = TempoMap ()
+
+
+   def feed (self, events):
+      for ticks, track, eventdata in events:
+         mc = eventdata[0] >> 4
+         if mc == 0x09 and eventdata[2] != 0:
+            # unlike the MidiImporter the percussion exclusion follows
+            # the program changes of each track on its own
+            if self.program.get (track) != 127:
+               self.add_note (eventdata[1], self.tempo.ticks (ticks), track)
+         elif mc == 0x0c:
+            self.program[track] = eventdata[1]
+         elif eventdata[:2] == b"\xff\x51" and len (eventdata) == 6:
+            self.tempo.add (ticks, (eventdata[3] << 16) + (eventdata[4] << 8) + eventdata[5])
+      self.stats.count ("notes", self.notes)
+      self.stats.count ("filtered notes", self.filtered)
+      return self
+
+
+   def add_note (self, note, ticks, track):
+      # notes have to come in time order, the same rules as
+      # PianoRoll.filter_repetition() and PianoRoll.min_repetition()
+      if track not in self.histograms:
+         self.histograms[track] = [0] * 128
+      self.histograms[track][note] += 1
+      self.notes += 1
+
+      last = self.last[note]
+      if last is not None:
+         d = ticks - last
+         if d < self.delta:
+            self.filtered += 1
+            return False
+         # notes at the same tick are considered identical
+         if d > 0:
+            self.mindelta = min (self.mindelta, d)
+      self.last[note] = ticks
+      return True
+
+
+   def pitch_histogram (self):
+      notecount = [0] * 128
+      for h in self.histograms.values ():
+         for i in range (128):
+            notecount[i] += h[i]
+      return notecount
+
+
+   def min_repetition (self):
+      if self.mindelta == sys.maxsize:
+         return 480
+      return self.mindelta
+
+
+   def count_unplayable (self, available_notes, transpose=[0]):
+      available = set (available_notes)
+      return sum ([h[note] for track, h in self.histograms.items ()
+                   for note in range (128)
+                   if note + transpose[track % len (transpose)] not in available])
+
+
+
+class RollCache (object):
+   # on-disk cache of parsed and analyzed rolls, keyed by the contents
+   # of the midi file and the options the analysis depends on. When the
+   # cache grows beyond max_size bytes the least recently used entries
+   # are removed.
+   version = 3
+   suffix = ".roll"
+
+   def __init__ (self, directory, max_size=64 << 20):
+      self.directory = directory
+      self.max_size = max_size
+
+
+   def key (self, data, options):
+      h = hashlib.sha256 (data)
+      h.update (repr ((self.version, options["ignore"], options["filter"],
+                       options["transpose"], options["autotracks"],
+                       options["octavetracks"])).encode ())
+      return h.hexdigest ()
+
+
+   def path (self, key):
+      return os.path.join (self.directory, key + self.suffix)
+
+
+   def encode (self, entry):
+      # only plain data is pickled, PianoRoll is __main__.PianoRoll when
+      # run from the command line and could not be loaded elsewhere
+      return dict (entry, roll=entry["roll"].as_data ())
+
+
+   def decode (self, data):
+      roll = PianoRoll ()
+      roll.set_data (data["roll"])
+      return dict (data, roll=roll)
+
+
+   def load (self, key):
+      # anything going wrong is a cache miss
+      try:
+         with open (self.path (key), "rb") as f:
+            entry = self.decode (pickle.load (f))
+         os.utime (self.path (key))
+         return entry
+      except Exception:
+         return None
+
 
-      while t:
-         if len (t) < 8:
-            print ("%d bytes remaining at end of MIDI file" % len(t), file=sys.stderr)
+   def store (self, key, entry, evict=True):
+      os.makedirs (self.directory, exist_ok=True)
+      fd, tmpname = tempfile.mkstemp (dir=self.directory, suffix=".tmp")
+      with os.fdopen (fd, "wb") as f:
+         pickle.dump (self.encode (entry), f, pickle.HIGHEST_PROTOCOL)
+      os.replace (tmpname, self.path (key))
+      if evict:
+         self.evict ()
+
+
+   def evict (self):
+      files = []
+      for name in os.listdir (self.directory):
+         if name.endswith (self.suffix):
+            try:
+               st = os.stat (os.path.join (self.directory, name))
+               files.append ((st.st_mtime, st.st_size, name))
+            except OSError:
+               pass
+      files.sort ()
+      total = sum ([f[1] for f in files])
+      while files and total > self.max_size:
+         mtime, size, name = files.pop (0)
+         try:
+            os.unlink (os.path.join (self.directory, name))
+         except OSError:
+            pass
+         total -= size
+
+
+class StripCache (RollCache):
+   # the cut plans of optimized strips for the incremental mode, keyed
+   # by the holes, the geometry and the optimize budget of the strip
+   version = 4
+   suffix = ".strip"
+
+   def encode (self, entry):
+      return entry
+
+
+   def decode (self, data):
+      return data
+
+
+   def key (self, strip, budget):
+      h = hashlib.sha256 (repr ((self.version, strip, budget)).encode ())
+      return h.hexdigest ()
+
+
+def default_cache_dir ():
+   base = os.environ.get ("XDG_CACHE_HOME") or os.path.join (os.path.expanduser ("~"), ".cache")
+   return os.path.join (base, "lamusica")
+
+
+def analyze (midifile, options, cache=None, stats=None):
+   with open (midifile, "rb") as f:
+      data = f.read ()
+   return analyze_data (data, options, cache, stats)
+
+
+def analyze_data (data, options, cache=None, stats=None):
+   # parses the tune and filters it, returns the cache entry with the
+   # roll, its minimum note repetition and the transposes found so far
+   stats = stats or Stats ()
+   with stats.timer ("cache"):
+      key = cache.key (data, options) if cache else None
+      entry = cache.load (key) if cache else None
+   if entry is not None:
+      stats.count ("cache hit")
+      return entry, key
+
+   roll = PianoRoll ()
+   with stats.timer ("parse"):
+      mi = MidiImporter (roll, stats)
+      mi.import_data (data, options["ignore"])
+   stats.count ("notes", len (roll))
+
+   with stats.timer ("filter"):
+      stats.log ("min. repetition:", roll.min_repetition (stats.verbose))
+      stats.count ("filtered notes", roll.filter_repetition (options["filter"]))
+      entry = { "roll"       : roll,
+                "mindelta"   : roll.min_repetition (stats.verbose),
+                "transposes" : {} }
+
+   if cache:
+      stats.count ("cache miss")
+      with stats.timer ("cache"):
+         cache.store (key, entry)
+
+   return entry, key
+
+
+def convert (midifile, boxtype, options):
+   # a single conversion job, all state lives in the roll
+   stats = Stats (options["verbose"])
+   cache = RollCache (options["cache"]) if options["cache"] else None
+   entry, key = analyze (midifile, options, cache, stats)
+
+   found = len (entry["transposes"])
+   result = render (entry, boxtype, options, stats)
+   if cache and len (entry["transposes"]) != found:
+      cache.store (key, entry)
+
+   result["file"] = midifile
+   result["stats"] = stats.as_dict ()
+   return result
+
+
+def render (entry, boxtype, options, stats):
+   # renders an analyzed tune for a box, the transposes found are
+   # added to the entry. They are kept per comb, not per box name, as
+   # the boxes may be redefined between runs.
+   model = models[boxtype]
+   available = model["pitches"]
+   roll = entry["roll"]
+   mindelta = entry["mindelta"]
+
+   with stats.timer ("transpose"):
+      if options["transpose"] != None:
+         roll.transpose = options["transpose"]
+      elif available in entry["transposes"]:
+         roll.transpose = entry["transposes"][available]
+      else:
+         if options["autotracks"]:
+            roll.transpose = roll.find_track_transpose (model, options["octavetracks"])
+         else:
+            roll.transpose = [ roll.find_transpose (available) ]
+         entry["transposes"][available] = roll.transpose
+
+   with stats.timer ("band"):
+      notelist = roll.get_compat_band (model)
+   stats.count ("holes", sum ([len (b) for b in notelist]))
+
+   # the strip may be scaled for a slower repetition than the tune's,
+   # the holes getting too close on a tooth are then resolved
+   stripdelta = options["repeat"] or mindelta
+   if options["collisions"]:
+      with stats.timer ("collisions"):
+         limit = restrike_ticks (model, stripdelta)
+         collisions = tooth_collisions (notelist, limit)
+         stats.count ("collisions", len (collisions))
+         print ("%d holes closer than %.1f mm on a tooth" % (len (collisions), model["restrike"]), file=sys.stderr)
+         for start, count, teeth in worst_passages (collisions, 4 * roll.timediv):
+            print ("    ticks %d-%d: %d collisions on %s" %
+                   (start, start + 4 * roll.timediv, count,
+                    ", ".join ([str (model["pitches"][i]) for i in teeth])),
+                   file=sys.stderr)
+         if options["collisions"] != "report":
+            notelist, counts = resolve_collisions (notelist, model, limit,
+                                                   options["collisions"])
+            for k in sorted (counts):
+               stats.count ("%s holes" % k, counts[k])
+            print ("    --> %d dropped, %d nudged, %d refolded" %
+                   (counts["dropped"], counts["nudged"], counts["refolded"]), file=sys.stderr)
+
+   with stats.timer ("render"):
+      if options["midi"]:
+         output_midi (model, options["midi"], notelist, mindelta, roll.timediv, roll.tempo)
+      if options["wav"]:
+         output_wav (model, options["wav"], notelist, stripdelta, options["crank"])
+
+      # the layout is shared by all paper sizes and backends
+      if options["pdf"] or options["svg"]:
+         strip_cache = None
+         if options["incremental"] and options["cache"]:
+            strip_cache = StripCache (options["cache"], 256 << 20)
+         layout = Layout (model, notelist, stripdelta, strip_cache)
+
+      for paper in options["paper"].split (","):
+         if options["pdf"]:
+            output_file (layout, options["pdf"].replace ("{paper}", paper), True,
+                         paper, options["optimize"], stats=stats,
+                         jobs=options["jobs"], pack=options["pack"])
+         if options["svg"]:
+            output_file (layout, options["svg"].replace ("{paper}", paper), False,
+                         paper, options["optimize"],
+                         options["svgwriter"] == "native", stats,
+                         options["jobs"], options["svgpages"], options["pack"])
+
+   return { "box"        : boxtype,
+            "transpose"  : roll.transpose,
+            "unplayable" : roll.count_unplayable (available),
+            "mindelta"   : mindelta }
+
+
+def fit_model (roll, model, mindelta, transpose=None):
+   # scores the roll on a box model, the roll is analyzed already
+   available = model["pitches"]
+   if transpose == None:
+      transpose = [ roll.find_transpose (available, verbose=False) ]
+
+   roll.transpose = transpose
+   stats = {}
+   notelist = roll.get_compat_band (model, stats)
+
+   times = [b[0] for b in notelist if b] + [b[-1] for b in notelist if b]
+   step = model["step"] / mindelta
+   if times:
+      length = int (max (times) - min (times)) * step + model["diameter"] + leadin + leadout
+   else:
+      length = 0.0
+
+   # repeated strikes of a tooth faster than the tune's own repetition
+   conflicts = len ([1 for b in notelist for t0, t1 in zip (b, b[1:])
+                     if t1 - t0 < mindelta])
+
+   return { "transpose"  : transpose,
+            "no_tooth"   : stats["no_tooth"],
+            "folded"     : stats["folded"],
+            "conflicts"  : conflicts,
+            "length"     : length }
+
+
+def compare_models (midifile, boxtypes, options):
+   # parses and analyzes the tune once and fits it on every box type
+   stats = Stats (options["verbose"])
+   cache = RollCache (options["cache"]) if options["cache"] else None
+   entry, key = analyze (midifile, options, cache, stats)
+   results = rank_models (entry["roll"], entry["mindelta"], boxtypes,
+                          options, stats)
+
+   print ("%-10s %10s %10s %8s %9s %10s" % ("box", "transpose", "no tooth",
+                                             "folded", "conflicts", "length/mm"))
+   for r in results:
+      print ("%-10s %10s %10d %8d %9d %10.1f" % (r["box"],
+                                                  ",".join ([str (t) for t in r["transpose"]]),
+                                                  r["no_tooth"], r["folded"],
+                                                  r["conflicts"], r["length"]))
+
+   if options["stats"]:
+      stats.report (options["stats"])
+
+   return results
+
+
+def rank_models (roll, mindelta, boxtypes, options, stats):
+   # fits the roll on every box type, the best first
+   results = []
+   for boxtype in boxtypes:
+      model = models[boxtype]
+      if options["transpose"] == None and options["autotracks"]:
+         transpose = roll.find_track_transpose (model, options["octavetracks"])
+      else:
+         transpose = options["transpose"]
+      with stats.timer ("fit"):
+         fit = fit_model (roll, model, mindelta, transpose)
+      fit["box"] = boxtype
+      results.append (fit)
+
+   results.sort (key=lambda r: (r["no_tooth"], r["folded"],
+                                r["conflicts"], r["length"]))
+   return results
+
+
+def stream_models (midifile, boxtypes, options):
+   # bounded memory analysis of huge tunes, the events are consumed
+   # while the file is decoded and no roll is built
+   stats = Stats (options["verbose"])
+   with stats.timer ("stream"):
+      analysis = StreamAnalysis (options["filter"], stats)
+      analysis.feed (iter_events (midifile, options["ignore"]))
+
+   print ("notes: %d, filtered: %d, min. repetition: %d" %
+          (analysis.notes, analysis.filtered, analysis.min_repetition ()))
+   results = []
+   with stats.timer ("transpose"):
+      notecount = analysis.pitch_histogram ()
+      for boxtype in boxtypes:
+         if analysis.notes == 0:
             break
-         chunkname = t[:4]
-         chunklen = struct.unpack (">I", t[4:8])[0]
-         if len (t) < 8+chunklen:
-            raise Exception ("Not enough bytes in MIDI file")
-         chunkdata = t[8:8+chunklen]
+         model = models[boxtype]
+         available = model["pitches"]
+         transpose = options["transpose"]
+         if transpose == None:
+            transpose = [ best_transpose (transpose_errors (notecount, available))[0] ]
+         results.append ({ "box"        : boxtype,
+                           "transpose"  : transpose,
+                           "unplayable" : analysis.count_unplayable (available, transpose) })
+
+   print ("%-10s %10s %10s" % ("box", "transpose", "unplayable"))
+   for r in results:
+      print ("%-10s %10s %10d" % (r["box"],
+                                  ",".join ([str (t) for t in r["transpose"]]),
+                                  r["unplayable"]))
+
+   if options["stats"]:
+      stats.report (options["stats"])
+
+   return results
+
+
+def batch_job (midifile, boxtype, options):
+   name = os.path.splitext (os.path.basename (midifile))[0]
+   # the jobs run in worker processes already
+   options = dict (options, jobs=1)
+   for o in ("midi", "wav", "pdf", "svg"):
+      if options[o]:
+         options[o] = options[o].format (name=name, box=boxtype, paper="{paper}")
+
+   try:
+      return convert (midifile, boxtype, options)
+   except Exception as e:
+      return { "file" : midifile, "box" : boxtype, "error" : str (e) }
+
+
+def run_batch (midifiles, boxtypes, options, report, jobs=None):
+   # one job per file and box type, spread over worker processes
+   import concurrent.futures
+
+   with concurrent.futures.ProcessPoolExecutor (jobs, initializer=use_models,
+                                                initargs=(models,)) as pool:
+      futures = [pool.submit (batch_job, f, b, options)
+                 for f in midifiles for b in boxtypes]
+      results = [f.result () for f in futures]
+
+   out = sys.stdout if report == "-" else open (report, "w")
+   print ("# file\tbox\ttranspose\tunplayable\tmindelta", file=out)
+   for r in results:
+      if "error" in r:
+         print ("%s\t%s\terror: %s" % (r["file"], r["box"], r["error"]), file=out)
+      else:
+         print ("%s\t%s\t%s\t%d\t%d" % (r["file"], r["box"],
+                                          ",".join ([str (t) for t in r["transpose"]]),
+                                          r["unplayable"], r["mindelta"]), file=out)
+   if out != sys.stdout:
+      out.close ()
+
+   if options["stats"]:
+      stats = Stats ()
+      for r in results:
+         if "stats" in r:
+            stats.merge (r["stats"])
+      stats.report (options["stats"])
+
+   return results
+
+
+class MemoryCache (RollCache):
+   # the analyzed rolls of the server, in memory. Beyond max_entries
+   # the least recently used ones are dropped.
+   def __init__ (self, max_entries=32):
+      self.max_entries = max_entries
+      self.entries = {}
+
+
+   def load (self, key):
+      entry = self.entries.pop (key, None)
+      if entry is not None:
+         self.entries[key] = entry
+      return entry
+
+
+   def store (self, key, entry):
+      self.entries.pop (key, None)
+      self.entries[key] = entry
+      self.evict ()
 
-         print (chunkname, chunklen, file=sys.stderr)
-         self.import_chunk (chunkname, chunkdata, ignoretracks)
-         t = t[8+chunklen:]
-      print ("%d tracks" % self.num_tracks)
 
+   def evict (self):
+      while len (self.entries) > self.max_entries:
+         del self.entries[next (iter (self.entries))]
+
+
+def serve_analyze (data, options):
+   # worker side of an upload, a file failing to parse is a bad request
+   try:
+      entry = analyze_data (data, options)[0]
+   except Exception as e:
+      raise ValueError ("invalid midi file: %s" % e)
+   if not len (entry["roll"]):
+      raise ValueError ("no notes in midi file")
+   return entry
+
+
+def serve_rank (entry, boxtypes, options):
+   # worker side of the analysis of an uploaded tune
+   return rank_models (entry["roll"], entry["mindelta"], boxtypes,
+                       options, Stats ())
+
+
+def serve_render (entry, boxtype, options, fmt):
+   # worker side of a preview: renders into a temporary file and
+   # returns the result, the transposes found and the file contents
+   with tempfile.TemporaryDirectory () as tmpdir:
+      options = dict (options, midi=None, wav=None, pdf=None, svg=None, jobs=1)
+      if fmt:
+         options[fmt] = os.path.join (tmpdir, "tune." + fmt)
+      with open (os.devnull, "w") as devnull, contextlib.redirect_stderr (devnull):
+         result = render (entry, boxtype, options, Stats ())
+      data = None
+      if fmt:
+         with open (options[fmt], "rb") as f:
+            data = f.read ()
+   return result, entry["transposes"], data
+
+
+class Server (object):
+   # a small HTTP/1.1 server for previews (see README). Parsing and
+   # rendering run on a bounded pool of worker processes, the analyzed
+   # tunes stay in memory, so changing the box or the transpose of an
+   # uploaded tune only renders it again.
+   content_types = { "midi" : "audio/midi",
+                     "wav"  : "audio/wav",
+                     "svg"  : "image/svg+xml",
+                     "pdf"  : "application/pdf" }
+
+   def __init__ (self, options, jobs=None, max_tunes=32):
+      self.options = dict (options, svgwriter="native", svgpages=False,
+                           stats=None, verbose=False, cache=None, jobs=1)
+      self.jobs = jobs or os.cpu_count () or 1
+      self.pool = self.new_pool ()
+      self.tunes = MemoryCache (max_tunes)
+      self.slots = None
+
+      # formats the server cannot write, like the checks of the command line
+      self.missing = {}
+      try:
+         import cairo
+      except ImportError:
+         self.missing["pdf"] = "PDF output needs pycairo, which is not installed"
+      try:
+         import numpy
+      except ImportError:
+         self.missing["wav"] = "WAV output needs numpy, which is not installed"
+
+
+   def new_pool (self):
+      import concurrent.futures
+      return concurrent.futures.ProcessPoolExecutor (self.jobs, initializer=use_models,
+                                                     initargs=(models,))
+
+
+   async def run_job (self, func, *args):
+      import asyncio, concurrent.futures
+      # at most two jobs per worker are queued, the others wait here
+      async with self.slots:
+         loop = asyncio.get_running_loop ()
+         pool = self.pool
+         try:
+            return await loop.run_in_executor (pool, func, *args)
+         except concurrent.futures.process.BrokenProcessPool:
+            # a worker died, the following jobs get a new pool
+            if self.pool is pool:
+               self.pool = self.new_pool ()
+            raise
+
+
+   def request_options (self, query, upload=False):
+      # the tune is analyzed with ignore, filter and the track
+      # options of the upload, the others may change with every request
+      options = dict (self.options)
+      for name, value in query.items ():
+         if name in ("ignore", "filter", "autotracks", "octavetracks") and not upload:
+            raise ValueError ("%s is an option of the upload" % name)
+         if name in ("transpose", "ignore", "octavetracks"):
+            options[name] = [ int (t) for t in value.split (",") ]
+         elif name in ("filter", "repeat", "pack"):
+            options[name] = int (value)
+         elif name in ("optimize", "crank"):
+            options[name] = float (value)
+         elif name == "autotracks":
+            options[name] = value not in ("", "0")
+         elif name == "paper":
+            if "," in value:
+               raise ValueError ("only one paper size per request")
+            page_geometry (value)
+            options[name] = value
+         elif name == "collisions":
+            if value not in ("report", "drop", "nudge", "refold"):
+               raise ValueError ("unknown collision strategy %s" % value)
+            options[name] = value
+         elif name not in ("box", "format"):
+            raise ValueError ("unknown option %s" % name)
+      if "octavetracks" in query:
+         options["autotracks"] = True
+      return options
+
+
+   def boxtypes (self, query, default):
+      box = query.get ("box", default)
+      boxtypes = sorted (models.keys ()) if box == "all" else box.split (",")
+      for b in boxtypes:
+         if b not in models:
+            raise ValueError ("unknown box type %s" % b)
+      return boxtypes
+
+
+   async def upload (self, data, query):
+      options = self.request_options (query, True)
+      key = self.tunes.key (data, options)
+      entry = self.tunes.load (key)
+      if entry is None:
+         entry = await self.run_job (serve_analyze, data, options)
+         self.tunes.store (key, entry)
+      return key, entry
+
+
+   async def preview (self, key, entry, query, fmt):
+      if fmt in self.missing:
+         raise NotImplementedError (self.missing[fmt])
+      options = self.request_options (query)
+      boxtype = self.boxtypes (query, "sankyo20")[0]
+      result, transposes, data = await self.run_job (serve_render, entry,
+                                                     boxtype, options, fmt)
+      entry["transposes"].update (transposes)
+      result["tune"] = key
+      headers = { "X-Transpose"  : ",".join ([str (t) for t in result["transpose"]]),
+                  "X-Unplayable" : str (result["unplayable"]) }
+      if fmt:
+         return 200, self.content_types[fmt], data, headers
+      return 200, "application/json", json.dumps (result).encode (), headers
+
+
+   async def dispatch (self, method, target, body):
+      import urllib.parse
+      url = urllib.parse.urlsplit (target)
+      query = dict (urllib.parse.parse_qsl (url.query, keep_blank_values=True))
+      path = [p for p in url.path.split ("/") if p]
+
+      if method == "POST" and path == ["tunes"]:
+         key, entry = await self.upload (body, query)
+         return 200, "application/json", json.dumps ({ "tune"     : key,
+                                                       "notes"    : len (entry["roll"]),
+                                                       "mindelta" : entry["mindelta"] }).encode (), {}
+
+      if method == "POST" and path == ["convert"]:
+         upload = dict ([(k, v) for k, v in query.items ()
+                         if k in ("ignore", "filter", "autotracks", "octavetracks")])
+         key, entry = await self.upload (body, upload)
+         query = dict ([(k, v) for k, v in query.items () if k not in upload])
+         fmt = query.get ("format", "midi")
+         if fmt not in self.content_types:
+            raise ValueError ("unknown format %s" % fmt)
+         return await self.preview (key, entry, query, fmt)
+
+      if method == "GET" and len (path) in (2, 3) and path[0] == "tunes":
+         entry = self.tunes.load (path[1])
+         if entry is None:
+            return 404, "application/json", b'{"error": "unknown tune"}', {}
+         if len (path) == 2:
+            options = self.request_options (query)
+            results = await self.run_job (serve_rank, entry,
+                                          self.boxtypes (query, "all"), options)
+            return 200, "application/json", json.dumps ({ "tune"     : path[1],
+                                                          "mindelta" : entry["mindelta"],
+                                                          "boxes"    : results }).encode (), {}
+         if path[2] == "render":
+            return await self.preview (path[1], entry, query, None)
+         if path[2] in self.content_types:
+            return await self.preview (path[1], entry, query, path[2])
+
+      return 404, "application/json", b'{"error": "not found"}', {}
+
+
+   async def handle (self, reader, writer):
+      import asyncio
+      reasons = { 200 : "OK", 400 : "Bad Request", 404 : "Not Found",
+                  500 : "Internal Server Error", 501 : "Not Implemented" }
+      try:
+         while True:
+            line = await reader.readline ()
+            if not line:
+               break
+            method, target, version = line.decode ("latin-1").split ()
+            headers = {}
+            while True:
+               line = await reader.readline ()
+               if line in (b"\r\n", b"\n", b""):
+                  break
+               name, colon, value = line.decode ("latin-1").partition (":")
+               headers[name.strip ().lower ()] = value.strip ()
+            body = await reader.readexactly (int (headers.get ("content-length", 0)))
+
+            # bad requests raise ValueError, anything else is our fault
+            try:
+               status, ctype, data, extra = await self.dispatch (method, target, body)
+            except Exception as e:
+               status = (400 if isinstance (e, ValueError) else
+                         501 if isinstance (e, NotImplementedError) else 500)
+               ctype, extra = "application/json", {}
+               data = json.dumps ({ "error" : str (e) or e.__class__.__name__ }).encode ()
+
+            keep = (version == "HTTP/1.1" and
+                    headers.get ("connection", "").lower () != "close")
+            head = ["HTTP/1.1 %d %s" % (status, reasons[status]),
+                    "Content-Type: %s" % ctype,
+                    "Content-Length: %d" % len (data),
+                    "Connection: %s" % ("keep-alive" if keep else "close")]
+            head += ["%s: %s" % h for h in sorted (extra.items ())]
+            writer.write (("\r\n".join (head) + "\r\n\r\n").encode ("latin-1") + data)
+            await writer.drain ()
+            if not keep:
+               break
+      except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+         pass
+      finally:
+         writer.close ()
+
+
+def serve (address, options, jobs=None):
+   # host:port or the path of a unix socket
+   import asyncio
+   # a stale socket is replaced, anything else at the path is kept
+   if "/" in address and os.path.exists (address):
+      if not stat.S_ISSOCK (os.stat (address).st_mode):
+         print ("%s exists and is not a socket" % address, file=sys.stderr)
+         sys.exit (2)
+      os.unlink (address)
+   server = Server (options, jobs)
+
+   async def run ():
+      server.slots = asyncio.Semaphore (2 * server.jobs)
+      if "/" in address:
+         s = await asyncio.start_unix_server (server.handle, address)
+      else:
+         host, colon, port = address.rpartition (":")
+         s = await asyncio.start_server (server.handle, host or "127.0.0.1", int (port))
+      print ("serving on %s with %d workers" % (address, server.jobs), file=sys.stderr)
+      async with s:
+         await s.serve_forever ()
+
+   try:
+      asyncio.run (run ())
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.pool.shutdown ()
 
 
 def usage ():
    print ("Usage: %s [arguments] <midi-file>" % sys.argv[0], file=sys.stderr)
+   print ("       %s --batch=report [arguments] <midi-files or globs...>" % sys.argv[0], file=sys.stderr)
+   print ("       %s --serve=address [arguments]" % sys.argv[0], file=sys.stderr)
    print ("  -h, --help: show usage", file=sys.stderr)
+   print ("  -v, --verbose: show midi events, chunks and analysis details", file=sys.stderr)
+   print ("      --stats=text|json: report time per stage and event counts (json on stdout)", file=sys.stderr)
    print ("  -t, --transpose=number: transpose by n halftones (avoid auto)", file=sys.stderr)
+   print ("  -a, --auto-tracks: search a separate transpose for every track", file=sys.stderr)
+   print ("  -O, --octave-tracks=list: tracks (e.g. accompaniment) only shifted by octaves, implies -a", file=sys.stderr)
    print ("  -f, --filter=number: ignore note-repetition faster than <ticks>", file=sys.stderr)
-   print ("  -b, --box=type: music box type: china15, sankyo20, china30, sankyo33", file=sys.stderr)
+   print ("  -r, --repeat=ticks: scale the strip for this note repetition instead of the fastest", file=sys.stderr)
+   print ("      --collisions=report|drop|nudge|refold: find (and resolve) holes too close on", file=sys.stderr)
+   print ("                    a tooth, report is the default with --repeat", file=sys.stderr)
+   print ("  -b, --box=type: music box type: %s" % ", ".join (models), file=sys.stderr)
    print ("  -m, --midi=filename: output midi file name (omit if not wanted)", file=sys.stderr)
+   print ("  -w, --wav=filename: output wav file name, the tune played on the box (needs numpy)", file=sys.stderr)
+   print ("      --crank=rpm: turns of the crank per minute for the wav (default 120)", file=sys.stderr)
    print ("  -p, --pdf=filename: output pdf file name (omit if not wanted)", file=sys.stderr)
    print ("  -s, --svg=filename: output svg file name (omit if not wanted)", file=sys.stderr)
+   print ("  -P, --paper=size: A4, A3 or WIDTHxHEIGHT in mm, a comma separated list for", file=sys.stderr)
+   print ("                    several sizes (pdf and svg file names then need {paper})", file=sys.stderr)
+   print ("  -o, --optimize=seconds: effort (~seconds) for ordering the holes for the laser, 0 keeps time order", file=sys.stderr)
+   print ("  -S, --svg-writer=cairo|native: native streams the svg without cairo", file=sys.stderr)
+   print ("      --svg-pages: one svg file per page (name-1.svg, name-2.svg, ...)", file=sys.stderr)
+   print ("  -k, --pack=level: 0 one strip per row, 1 fill the rows with the strips in order,", file=sys.stderr)
+   print ("                    2 also try reordered (numbered) strips, slower", file=sys.stderr)
+   print ("  -C, --cache=directory: cache for analyzed tunes (default %s)" % default_cache_dir (), file=sys.stderr)
+   print ("      --no-cache: always parse and analyze the tune", file=sys.stderr)
+   print ("  -I, --incremental: keep the optimized strips in the cache, only changed strips", file=sys.stderr)
+   print ("                     are optimized again (needs the cache and --optimize > 0)", file=sys.stderr)
+   print ("  -c, --compare: rank all box types (or those given with --box) for the tune", file=sys.stderr)
+   print ("      --stream: analyze huge tunes with bounded memory, no output files", file=sys.stderr)
+   print ("  -B, --batch=filename: convert all files for all boxes, write summary (- for stdout)", file=sys.stderr)
+   print ("                        --box takes a comma separated list or \"all\",", file=sys.stderr)
+   print ("                        output file names may use {name} and {box}", file=sys.stderr)
+   print ("  -j, --jobs=number: number of worker processes (batch mode, strips and pages, server)", file=sys.stderr)
+   print ("      --serve=address: run a preview server on host:port or a unix socket path", file=sys.stderr)
 
 
 
 if __name__=='__main__':
+   models.update (load_models ({}, default_model_dirs ()))
+
    try:
       opts, args = getopt.getopt (sys.argv[1:],
-                                  "ht:f:i:b:m:s:p:P:",
-                                  ["help", "transpose=",
-                                  "filter=", "ignore=", "box=",
-                                  "midi=", "svg=", "pdf=", "paper="])
+                                  "hvt:aO:f:r:i:b:m:w:s:p:P:o:S:k:C:IcB:j:",
+                                  ["help", "verbose", "stats=", "transpose=",
+                                  "auto-tracks", "octave-tracks=",
+                                  "filter=", "repeat=", "collisions=",
+                                  "ignore=", "box=",
+                                  "midi=", "wav=", "crank=", "svg=", "pdf=", "paper=",
+                                  "optimize=", "svg-writer=", "svg-pages", "pack=",
+                                  "cache=", "no-cache", "incremental",
+                                  "compare", "stream",
+                                  "batch=", "jobs=", "serve="])
    except getopt.GetoptError as err:
       usage()
       sys.exit (2)
 
-   if len (args) != 1:
-      usage()
-      sys.exit (2)
-
-   midifile = None
-   svgfile = None
-   pdffile = None
-   papersize = "A4"
-   filter = 1
-   boxtype = "sankyo20"
-   transpose = None
-   ignoretracks = []
+   options = {
+      "midi"      : None,
+      "wav"       : None,
+      "crank"     : 120.0,
+      "svg"       : None,
+      "pdf"       : None,
+      "paper"     : "A4",
+      "filter"    : 1,
+      "repeat"    : None,
+      "collisions": None,
+      "transpose" : None,
+      "ignore"    : [],
+      "optimize"  : 1.0,
+      "svgwriter" : "cairo",
+      "svgpages"  : False,
+      "pack"      : 0,
+      "autotracks"   : False,
+      "octavetracks" : [],
+      "cache"        : default_cache_dir (),
+      "incremental"  : False,
+      "verbose"      : False,
+      "stats"        : None,
+      "jobs"         : 1,
+   }
+   boxtype = None
+   report = None
+   jobs = None
+   compare = False
+   stream = False
+   address = None
 
    for o, a in opts:
       if o in ("-h", "--help"):
          usage()
          sys.exit()
       elif o in ("-t", "--transpose"):
-         transpose = [ int (t) for t in a.split (",") ]
+         options["transpose"] = [ int (t) for t in a.split (",") ]
+      elif o in ("-a", "--auto-tracks"):
+         options["autotracks"] = True
+      elif o in ("-O", "--octave-tracks"):
+         options["autotracks"] = True
+         options["octavetracks"] = [ int (t) for t in a.split (",") ]
       elif o in ("-f", "--filter"):
-         filter = int (a)
+         options["filter"] = int (a)
+      elif o in ("-r", "--repeat"):
+         options["repeat"] = int (a)
+      elif o in ("--collisions",):
+         if a not in ("report", "drop", "nudge", "refold"):
+            usage()
+            sys.exit (2)
+         options["collisions"] = a
       elif o in ("-b", "--box"):
          boxtype = a
       elif o in ("-m", "--midi"):
-         midifile = a
+         options["midi"] = a
+      elif o in ("-w", "--wav"):
+         options["wav"] = a
+      elif o in ("--crank",):
+         options["crank"] = float (a)
       elif o in ("-s", "--svg"):
-         svgfile = a
+         options["svg"] = a
       elif o in ("-p", "--pdf"):
-         pdffile = a
+         options["pdf"] = a
       elif o in ("-P", "--paper"):
-         papersize = a
+         options["paper"] = a
       elif o in ("-i", "--ignore"):
-         ignoretracks = [ int (t) for t in a.split (",") ]
+         options["ignore"] = [ int (t) for t in a.split (",") ]
+      elif o in ("-o", "--optimize"):
+         options["optimize"] = float (a)
+      elif o in ("-S", "--svg-writer"):
+         if a not in ("cairo", "native"):
+            usage()
+            sys.exit (2)
+         options["svgwriter"] = a
+      elif o in ("--svg-pages",):
+         options["svgpages"] = True
+      elif o in ("-k", "--pack"):
+         options["pack"] = int (a)
+      elif o in ("-v", "--verbose"):
+         options["verbose"] = True
+      elif o in ("--stats",):
+         if a not in ("text", "json"):
+            usage()
+            sys.exit (2)
+         options["stats"] = a
+      elif o in ("-C", "--cache"):
+         options["cache"] = a
+      elif o in ("--no-cache",):
+         options["cache"] = None
+      elif o in ("-I", "--incremental"):
+         options["incremental"] = True
+      elif o in ("-c", "--compare"):
+         compare = True
+      elif o in ("--stream",):
+         stream = True
+      elif o in ("-B", "--batch"):
+         report = a
+      elif o in ("-j", "--jobs"):
+         jobs = int (a)
+         options["jobs"] = jobs
+      elif o in ("--serve",):
+         address = a
       else:
          assert False, "unhandled option"
 
-   model = models.get (boxtype, None)
-   if not model:
-      print ("Boxtype unknown. Available boxtypes are:", file=sys.stderr)
-      ms = list(models.keys ())
-      ms.sort ()
-      print ("  * %s" % "\n  * ".join (ms), file=sys.stderr)
-      sys.exit (2)
+   if address != None:
+      serve (address, options, jobs)
+      sys.exit ()
 
-   roll = PianoRoll()
-   mi = MidiImporter (roll)
-   mi.import_file (args[0], ignoretracks)
-
-   print (roll.min_repetition ())
-   roll.filter_repetition (filter)
+   if report == None and len (args) != 1:
+      usage()
+      sys.exit (2)
 
-   if transpose == None:
-      roll.transpose = [ roll.find_transpose ([model["lowest"] + i for i in model["notes"]]) ]
-   else:
-      roll.transpose = transpose
+   if boxtype == None:
+      boxtype = "all" if compare else "sankyo20"
 
-   notelist = roll.get_compat_band (model)
-   mindelta = roll.min_repetition ()
+   if options["repeat"] and not options["collisions"]:
+      options["collisions"] = "report"
 
-   if midifile:
-      output_midi (model, midifile, notelist, mindelta)
+   # the strip cache only holds optimized cut orders
+   if options["incremental"] and (not options["cache"] or options["optimize"] <= 0):
+      print ("--incremental needs the cache and --optimize > 0", file=sys.stderr)
+      sys.exit (2)
 
-   if pdffile:
-      output_file (model, pdffile, True, notelist, mindelta, papersize)
-   if svgfile:
-      output_file (model, svgfile, False, notelist, mindelta, papersize)
+   if (report != None or compare or stream) and boxtype == "all":
+      boxtypes = sorted (models.keys ())
+   elif report != None or compare or stream:
+      boxtypes = boxtype.split (",")
+   else:
+      boxtypes = [boxtype]
+
+   for b in boxtypes:
+      if b not in models:
+         print ("Boxtype unknown. Available boxtypes are:", file=sys.stderr)
+         ms = list(models.keys ())
+         ms.sort ()
+         print ("  * %s" % "\n  * ".join (ms), file=sys.stderr)
+         sys.exit (2)
+
+   if compare:
+      compare_models (args[0], boxtypes, options)
+      sys.exit ()
+
+   if stream:
+      stream_models (args[0], boxtypes, options)
+      sys.exit ()
+
+   height = max ([models[b]["height"] for b in boxtypes])
+   for paper in options["paper"].split (","):
+      try:
+         page_geometry (paper, height)
+      except ValueError:
+         print ("invalid paper size %s" % paper, file=sys.stderr)
+         sys.exit (2)
+
+   for o in ("pdf", "svg"):
+      if options[o] and "," in options["paper"] and "{paper}" not in options[o]:
+         print ("with several paper sizes the %s file name needs a {paper} placeholder" % o, file=sys.stderr)
+         sys.exit (2)
+
+   if options["pdf"] or (options["svg"] and options["svgwriter"] == "cairo"):
+      try:
+         import cairo
+      except ImportError:
+         print ("PDF and SVG output need pycairo, which is not installed", file=sys.stderr)
+         sys.exit (2)
+
+   if options["wav"]:
+      try:
+         import numpy
+      except ImportError:
+         print ("WAV output needs numpy, which is not installed", file=sys.stderr)
+         sys.exit (2)
+
+   if report == None:
+      result = convert (args[0], boxtype, options)
+      if options["stats"]:
+         stats = Stats ()
+         stats.merge (result["stats"])
+         stats.report (options["stats"])
+      sys.exit ()
+
+   midifiles = []
+   for a in args:
+      midifiles += sorted (glob.glob (a)) or [a]
+
+   for o in ("midi", "wav", "pdf", "svg"):
+      if options[o] and ((len (midifiles) > 1 and "{name}" not in options[o]) or
+                         (len (boxtypes) > 1 and "{box}" not in options[o])):
+         print ("in batch mode the %s file name needs {name} and {box} placeholders" % o, file=sys.stderr)
+         sys.exit (2)
+
+   run_batch (midifiles, boxtypes, options, report, jobs)